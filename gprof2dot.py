@@ -26,8 +26,9 @@ import math
 import os.path
 import re
 import textwrap
-import optparse
+import argparse
 import xml.parsers.expat
+import array
 import collections
 import locale
 import json
@@ -35,10 +36,36 @@ import fnmatch
 import codecs
 import io
 import hashlib
+import functools
+import mmap
+import threading
+import concurrent.futures
+
+# orjson parses large JSON profiles several times faster than the stdlib;
+# ijson streams them with a bounded working set.  Use either when present,
+# but never require them.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import ijson
+except ImportError:
+    ijson = None
 
 assert sys.version_info[0] >= 3
 
 
+# Profiles repeat the same handful of module paths for many functions;
+# memoize the path juggling instead of re-parsing the string each time.
+_basename = functools.lru_cache(maxsize=1024)(os.path.basename)
+
+
+@functools.lru_cache(maxsize=1024)
+def _module_from_filename(filename):
+    return os.path.basename(os.path.splitext(filename)[0])
+
+
 ########################################################################
 # Model
 
@@ -48,10 +75,10 @@ timeFormat = "%.7g"
 
 
 def times(x):
-    return "%u%s" % (x, MULTIPLICATION_SIGN)
+    return f"{int(x)}{MULTIPLICATION_SIGN}"
 
 def percentage(p):
-    return "%.02f%%" % (p*100.0,)
+    return f"{p*100.0:.02f}%"
 
 def fmttime(t):
     return timeFormat % t
@@ -64,9 +91,11 @@ def fail(a, b):
 
 # To enhance readability, labels are rounded to the number of decimal
 # places corresponding to the tolerance value.
-def round_difference(difference, tolerance):
-    n = -math.floor(math.log10(tolerance))
-    return round(difference, n)
+def tolerance_decimals(tolerance):
+    return -math.floor(math.log10(tolerance))
+
+def round_difference(difference, decimals):
+    return round(difference, decimals)
 
 
 def rescale_difference(x, min_val, max_val):
@@ -76,12 +105,10 @@ def rescale_difference(x, min_val, max_val):
 def min_max_difference(profile1, profile2):
     f1_events = [f1[TOTAL_TIME_RATIO] for _, f1 in sorted_iteritems(profile1.functions)]
     f2_events = [f2[TOTAL_TIME_RATIO] for _, f2 in sorted_iteritems(profile2.functions)]
-    differences = []
-    for i in range(len(f1_events)):
-        try:
-            differences.append(abs(f1_events[i] - f2_events[i]) * 100)
-        except IndexError:
-            differences.append(0)
+    # Compare pairwise up to the shorter list; missing entries count as zero
+    n = min(len(f1_events), len(f2_events))
+    differences = [abs(f1_events[i] - f2_events[i]) * 100 for i in range(n)]
+    differences += [0] * (len(f1_events) - n)
 
     return min(differences), max(differences)
 
@@ -89,11 +116,10 @@ def min_max_difference(profile1, profile2):
 tol = 2 ** -23
 
 def ratio(numerator, denominator):
-    try:
-        ratio = float(numerator)/float(denominator)
-    except ZeroDivisionError:
+    if denominator == 0:
         # 0/0 is undefined, but 1.0 yields more useful results
         return 1.0
+    ratio = numerator/denominator
     if ratio < 0.0:
         if ratio < -tol:
             sys.stderr.write('warning: negative ratio (%s/%s)\n' % (numerator, denominator))
@@ -105,6 +131,41 @@ def ratio(numerator, denominator):
     return ratio
 
 
+class _WarningAggregator:
+    """Collect repeated warnings and emit one line per kind.
+
+    Malformed profiles can trigger the same warning for millions of
+    functions or edges; writing each occurrence to stderr dominates the
+    run.  The first message of each kind is kept verbatim and the rest
+    are counted and summarized on flush.
+    """
+
+    def __init__(self):
+        self.counts = collections.Counter()
+        self.first = {}
+        # compare mode parses the two profiles on concurrent threads, so
+        # adds and flushes of this shared aggregator must not interleave
+        self._lock = threading.Lock()
+
+    def add(self, kind, message):
+        with self._lock:
+            self.counts[kind] += 1
+            if kind not in self.first:
+                self.first[kind] = message
+
+    def flush(self):
+        with self._lock:
+            counts, self.counts = self.counts, collections.Counter()
+            first, self.first = self.first, {}
+        for kind, count in counts.items():
+            sys.stderr.write(first[kind])
+            if count > 1:
+                sys.stderr.write('warning: %u similar %s warnings suppressed\n' % (count - 1, kind))
+
+
+_warnings = _WarningAggregator()
+
+
 class UndefinedEvent(Exception):
     """Raised when attempting to get an event which is undefined."""
 
@@ -117,13 +178,22 @@ class UndefinedEvent(Exception):
 
 
 class Event:
-    """Describe a kind of event, and its basic operations."""
+    """Describe a kind of event, and its basic operations.
+
+    Events are module-level singletons.  Each gets a sequential slot id, and
+    objects store event values in a flat list indexed by it, which is cheaper
+    than hashing Event keys in the tight loops of call_ratios and integrate.
+    """
+
+    _registry = []
 
     def __init__(self, name, null, aggregator, formatter = str):
         self.name = name
         self._null = null
         self._aggregator = aggregator
         self._formatter = formatter
+        self.slot = len(Event._registry)
+        Event._registry.append(self)
 
     def __repr__(self):
         return self.name
@@ -173,33 +243,78 @@ defaultLabelNames = ['total-time-percentage', 'self-time-percentage']
 totalMethod = 'callratios'
 
 
+def integrate_total(profile):
+    """Compute total time ratios according to totalMethod."""
+    if totalMethod == "callratios":
+        # Heuristic approach.  TOTAL_SAMPLES is unused.
+        profile.integrate(TOTAL_TIME_RATIO, TIME_RATIO)
+    elif totalMethod == "callstacks":
+        # Use the actual call chains for functions.
+        profile[TOTAL_SAMPLES] = profile[SAMPLES]
+        profile.ratio(TOTAL_TIME_RATIO, TOTAL_SAMPLES)
+        # Then propagate that total time to the calls.
+        functions = profile.functions
+        ttr = TOTAL_TIME_RATIO
+        for function in functions.values():
+            for call in function.calls.values():
+                if call.ratio is not None:
+                    call[ttr] = call.ratio * functions[call.callee_id][ttr]
+    else:
+        assert False
+
+# Set GPROF2DOT_VALIDATE to enable the O(V+E) sanity sweeps over the whole
+# graph in Profile.integrate and friends.  They only catch internal
+# inconsistencies, so production runs skip them.
+_VALIDATE = bool(os.environ.get('GPROF2DOT_VALIDATE'))
+
+
 class Object:
     """Base class for all objects in profile which can store events."""
 
+    # Keep instances dict-less: profiles can hold millions of calls, and the
+    # per-instance __dict__ would dwarf the actual event data.
+    __slots__ = ('events',)
+
     def __init__(self, events=None):
-        if events is None:
-            self.events = {}
-        else:
-            self.events = events
+        # Allocated lazily on first write: many calls never carry any event
+        # data, and skipping the empty list saves memory on large profiles.
+        self.events = events
 
     def __lt__(self, other):
         return id(self) < id(other)
 
     def __contains__(self, event):
-        return event in self.events
+        return self.events is not None and self.events[event.slot] is not None
 
     def __getitem__(self, event):
-        try:
-            return self.events[event]
-        except KeyError:
+        if self.events is None:
+            raise UndefinedEvent(event)
+        value = self.events[event.slot]
+        if value is None:
             raise UndefinedEvent(event)
+        return value
 
     def __setitem__(self, event, value):
-        if value is None:
-            if event in self.events:
-                del self.events[event]
+        if self.events is None:
+            self.events = [None]*len(Event._registry)
+        self.events[event.slot] = value
+
+
+def strip_paired(s, open_ch, close_ch):
+    """Remove balanced open_ch/close_ch delimited regions, including nested
+    ones, in a single pass.  Unbalanced delimiters are left untouched."""
+
+    out = []
+    opens = []
+    for ch in s:
+        if ch == open_ch:
+            opens.append(len(out))
+            out.append(ch)
+        elif ch == close_ch and opens:
+            del out[opens.pop():]
         else:
-            self.events[event] = value
+            out.append(ch)
+    return ''.join(out)
 
 
 class Call(Object):
@@ -208,16 +323,40 @@ class Call(Object):
     There should be at most one call object for every pair of functions.
     """
 
+    __slots__ = ('callee_id', 'callee', 'ratio', 'weight')
+
     def __init__(self, callee_id):
         Object.__init__(self)
         self.callee_id = callee_id
+        # Resolved to the callee Function by Profile.validate
+        self.callee = None
         self.ratio = None
         self.weight = None
 
+    @classmethod
+    def make(cls, callee_id, event, value):
+        """Build a call carrying one event in a single step.
+
+        Fast path for the per-frame parser loops, which allocate millions
+        of calls."""
+        call = cls.__new__(cls)
+        events = [None]*len(Event._registry)
+        events[event.slot] = value
+        call.events = events
+        call.callee_id = callee_id
+        call.callee = None
+        call.ratio = None
+        call.weight = None
+        return call
+
 
 class Function(Object):
     """A function."""
 
+    __slots__ = ('id', 'name', 'module', 'process', 'calls', 'called',
+                 'weight', 'cycle', 'filename', '_stripped_name', '_idx',
+                 '_last_eid')
+
     def __init__(self, id, name):
         Object.__init__(self)
         self.id = id
@@ -229,10 +368,14 @@ class Function(Object):
         self.weight = None
         self.cycle = None
         self.filename = None
+        self._stripped_name = None
+        self._idx = None
+        self._last_eid = 0
 
     def add_call(self, call):
         if call.callee_id in self.calls:
-            sys.stderr.write('warning: overwriting call from function %s to %s\n' % (str(self.id), str(call.callee_id)))
+            _warnings.add('overwriting call',
+                          'warning: overwriting call from function %s to %s\n' % (str(self.id), str(call.callee_id)))
         self.calls[call.callee_id] = call
 
     def get_call(self, callee_id):
@@ -244,30 +387,27 @@ class Function(Object):
             self.calls[callee_id] = call
         return self.calls[callee_id]
 
-    _parenthesis_re = re.compile(r'\([^()]*\)')
-    _angles_re = re.compile(r'<[^<>]*>')
     _const_re = re.compile(r'\s+const$')
 
     def stripped_name(self):
         """Remove extraneous information from C++ demangled function names."""
 
+        # The name never changes after construction, so cache the result
+        if self._stripped_name is not None:
+            return self._stripped_name
+
         name = self.name
 
-        # Strip function parameters from name by recursively removing paired parenthesis
-        while True:
-            name, n = self._parenthesis_re.subn('', name)
-            if not n:
-                break
+        # Strip function parameters from name by removing paired parenthesis
+        name = strip_paired(name, '(', ')')
 
         # Strip const qualifier
         name = self._const_re.sub('', name)
 
-        # Strip template parameters from name by recursively removing paired angles
-        while True:
-            name, n = self._angles_re.subn('', name)
-            if not n:
-                break
+        # Strip template parameters from name by removing paired angles
+        name = strip_paired(name, '<', '>')
 
+        self._stripped_name = name
         return name
 
     # TODO: write utility functions
@@ -281,7 +421,18 @@ class Function(Object):
                        sep2:between attribute name and value,
                        sep3: inserted at end
         """
-        return sep1.join(sep2.join([k,str(v)]) for (k,v) in sorted(self.__dict__.items())) + sep3
+        attrs = {name: getattr(self, name) for name in Object.__slots__ + Function.__slots__
+                 if not name.startswith('_')}
+        # decode the flat events slot list back into the named mapping shown
+        # before events moved to slots, as _dump_events does
+        events = self.events
+        if events is None:
+            attrs['events'] = {}
+        else:
+            attrs['events'] = {event: events[event.slot]
+                               for event in Event._registry
+                               if events[event.slot] is not None}
+        return sep1.join(sep2.join([k,str(v)]) for (k,v) in sorted(attrs.items())) + sep3
 
 
 class Cycle(Object):
@@ -308,10 +459,13 @@ class Profile(Object):
         Object.__init__(self)
         self.functions = {}
         self.cycles = []
+        self._edges_up = None
+        self._function_index = None
 
     def add_function(self, function):
         if function.id in self.functions:
-            sys.stderr.write('warning: overwriting function %s (id %s)\n' % (function.name, str(function.id)))
+            _warnings.add('overwriting function',
+                          'warning: overwriting function %s (id %s)\n' % (function.name, str(function.id)))
         self.functions[function.id] = function
 
     def add_cycle(self, cycle):
@@ -322,10 +476,18 @@ class Profile(Object):
 
         for function in self.functions.values():
             for callee_id in list(function.calls.keys()):
-                assert function.calls[callee_id].callee_id == callee_id
+                call = function.calls[callee_id]
+                assert call.callee_id == callee_id
                 if callee_id not in self.functions:
-                    sys.stderr.write('warning: call to undefined function %s from function %s\n' % (str(callee_id), function.name))
+                    _warnings.add('undefined function',
+                                  'warning: call to undefined function %s from function %s\n' % (str(callee_id), function.name))
                     del function.calls[callee_id]
+                else:
+                    # Resolve the callee once, so traversals don't need to
+                    # look it up in the functions dict per edge
+                    call.callee = self.functions[callee_id]
+        self._invalidate_derived_maps()
+        _warnings.flush()
 
     def find_cycles(self):
         """Find cycles using Tarjan's strongly connected components algorithm."""
@@ -349,15 +511,18 @@ class Profile(Object):
 
     def prune_root(self, roots, depth=-1):
         visited = set()
-        frontier = set([(root_node, depth) for root_node in roots])
-        while len(frontier) > 0:
-            node, node_depth = frontier.pop()
+        frontier = collections.deque((root_node, depth) for root_node in roots)
+        while frontier:
+            node, node_depth = frontier.popleft()
+            if node in visited:
+                continue
             visited.add(node)
             if node_depth == 0:
                 continue
             f = self.functions[node]
-            newNodes = set(f.calls.keys()) - visited
-            frontier = frontier.union({(new_node, node_depth - 1) for new_node in newNodes})
+            for new_node in f.calls.keys():
+                if new_node not in visited:
+                    frontier.append((new_node, node_depth - 1))
         subtreeFunctions = {}
         for n in visited:
             f = self.functions[n]
@@ -368,22 +533,51 @@ class Profile(Object):
             f.calls = newCalls
             subtreeFunctions[n] = f
         self.functions = subtreeFunctions
+        self._invalidate_derived_maps()
+
+    def _invalidate_derived_maps(self):
+        self._edges_up = None
+        self._function_index = None
+
+    def _build_function_index(self):
+        """Map each function id to its insertion position.
+
+        Used to process functions found through the reverse-edge map in the
+        same order a scan over self.functions would, keeping results stable.
+        """
+        if self._function_index is None:
+            self._function_index = {function_id: index
+                                    for index, function_id in enumerate(self.functions)}
+        return self._function_index
+
+    def _build_reverse_edges(self):
+        """Map each function id to the set of ids of functions calling it.
+
+        The map is cached and invalidated whenever edges are mutated.
+        """
+        if self._edges_up is None:
+            edgesUp = collections.defaultdict(set)
+            for f in self.functions.keys():
+                for n in self.functions[f].calls.keys():
+                    edgesUp[n].add(f)
+            self._edges_up = edgesUp
+        return self._edges_up
 
     def prune_leaf(self, leafs, depth=-1):
-        edgesUp = collections.defaultdict(set)
-        for f in self.functions.keys():
-            for n in self.functions[f].calls.keys():
-                edgesUp[n].add(f)
+        edgesUp = self._build_reverse_edges()
         # build the tree up
         visited = set()
-        frontier = set([(leaf_node, depth) for leaf_node in leafs])
-        while len(frontier) > 0:
-            node, node_depth = frontier.pop()
+        frontier = collections.deque((leaf_node, depth) for leaf_node in leafs)
+        while frontier:
+            node, node_depth = frontier.popleft()
+            if node in visited:
+                continue
             visited.add(node)
             if node_depth == 0:
                 continue
-            newNodes = edgesUp[node] - visited
-            frontier = frontier.union({(new_node, node_depth - 1) for new_node in newNodes})
+            for new_node in edgesUp[node]:
+                if new_node not in visited:
+                    frontier.append((new_node, node_depth - 1))
         downTree = set(self.functions.keys())
         upTree = visited
         path = downTree.intersection(upTree)
@@ -397,6 +591,7 @@ class Profile(Object):
             f.calls = newCalls
             pathFunctions[n] = f
         self.functions = pathFunctions
+        self._invalidate_derived_maps()
 
     def getFunctionIds(self, funcName):
         function_names = {v.name: k for (k, v) in self.functions.items()}
@@ -443,66 +638,97 @@ class Profile(Object):
     def _tarjan(self, function, order, stack, data):
         """Tarjan's strongly connected components algorithm.
 
+        Implemented iteratively with an explicit work stack, so that huge
+        call graphs do not hit the interpreter recursion limit.
+
         See also:
         - http://en.wikipedia.org/wiki/Tarjan's_strongly_connected_components_algorithm
         """
 
-        try:
-            func_data = data[function.id]
+        if function.id in data:
             return order
-        except KeyError:
-            func_data = self._TarjanData(order)
-            data[function.id] = func_data
+
+        func_data = self._TarjanData(order)
+        data[function.id] = func_data
         order += 1
-        pos = len(stack)
+        # Each entry mirrors one recursive invocation: the function's Tarjan
+        # bookkeeping, its position on the SCC stack, and the calls still to
+        # be visited.
+        work = [(func_data, len(stack), iter(function.calls.values()))]
         stack.append(function)
         func_data.onstack = True
-        for call in function.calls.values():
-            try:
-                callee_data = data[call.callee_id]
-                if callee_data.onstack:
-                    func_data.lowlink = min(func_data.lowlink, callee_data.order)
-            except KeyError:
-                callee = self.functions[call.callee_id]
-                order = self._tarjan(callee, order, stack, data)
-                callee_data = data[call.callee_id]
-                func_data.lowlink = min(func_data.lowlink, callee_data.lowlink)
-        if func_data.lowlink == func_data.order:
-            # Strongly connected component found
-            members = stack[pos:]
-            del stack[pos:]
-            if len(members) > 1:
-                cycle = Cycle()
-                for member in members:
-                    cycle.add_function(member)
-                    data[member.id].onstack = False
-            else:
-                for member in members:
-                    data[member.id].onstack = False
+
+        functions = self.functions
+        data_get = data.get
+        while work:
+            func_data, pos, calls_iter = work[-1]
+            descended = False
+            for call in calls_iter:
+                callee_id = call.callee_id
+                callee_data = data_get(callee_id)
+                if callee_data is None:
+                    # Unvisited callee: push a new frame for it
+                    callee = functions[callee_id]
+                    callee_data = self._TarjanData(order)
+                    data[callee_id] = callee_data
+                    order += 1
+                    work.append((callee_data, len(stack), iter(callee.calls.values())))
+                    stack.append(callee)
+                    callee_data.onstack = True
+                    descended = True
+                    break
+                if callee_data.onstack and callee_data.order < func_data.lowlink:
+                    func_data.lowlink = callee_data.order
+            if descended:
+                continue
+            # All calls visited: pop the frame and propagate the lowlink
+            work.pop()
+            if work:
+                parent_data = work[-1][0]
+                if func_data.lowlink < parent_data.lowlink:
+                    parent_data.lowlink = func_data.lowlink
+            if func_data.lowlink == func_data.order:
+                # Strongly connected component found
+                members = stack[pos:]
+                del stack[pos:]
+                if len(members) > 1:
+                    cycle = Cycle()
+                    for member in members:
+                        cycle.add_function(member)
+                        data[member.id].onstack = False
+                else:
+                    for member in members:
+                        data[member.id].onstack = False
         return order
 
     def call_ratios(self, event):
-        # Aggregate for incoming calls
-        cycle_totals = {}
-        for cycle in self.cycles:
-            cycle_totals[cycle] = 0.0
-        function_totals = {}
-        for function in self.functions.values():
-            function_totals[function] = 0.0
+        # Aggregate for incoming calls.  The totals live in flat double
+        # arrays indexed by per-object positions assigned here, which is
+        # cheaper and more compact than dicts keyed by object identity.
+        for index, cycle in enumerate(self.cycles):
+            cycle._idx = index
+        cycle_totals = array.array('d', [0.0]*len(self.cycles))
+        for index, function in enumerate(self.functions.values()):
+            function._idx = index
+        function_totals = array.array('d', [0.0]*len(self.functions))
 
         # Pass 1:  function_total gets the sum of call[event] for all
         #          incoming arrows.  Same for cycle_total for all arrows
         #          that are coming into the *cycle* but are not part of it.
+        event_slot = event.slot
         for function in self.functions.values():
             for call in function.calls.values():
                 if call.callee_id != function.id:
-                    callee = self.functions[call.callee_id]
-                    if event in call.events:
-                        function_totals[callee] += call[event]
+                    callee = call.callee
+                    events = call.events
+                    value = events[event_slot] if events is not None else None
+                    if value is not None:
+                        function_totals[callee._idx] += value
                         if callee.cycle is not None and callee.cycle is not function.cycle:
-                            cycle_totals[callee.cycle] += call[event]
+                            cycle_totals[callee.cycle._idx] += value
                     else:
-                        sys.stderr.write("call_ratios: No data for " + function.name + " call to " + callee.name + "\n")
+                        _warnings.add('call_ratios no data',
+                                      "call_ratios: No data for " + function.name + " call to " + callee.name + "\n")
 
         # Pass 2:  Compute the ratios.  Each call[event] is scaled by the
         #          function_total of the callee.  Calls into cycles use the
@@ -511,16 +737,19 @@ class Profile(Object):
             for call in function.calls.values():
                 assert call.ratio is None
                 if call.callee_id != function.id:
-                    callee = self.functions[call.callee_id]
-                    if event in call.events:
+                    callee = call.callee
+                    events = call.events
+                    value = events[event_slot] if events is not None else None
+                    if value is not None:
                         if callee.cycle is not None and callee.cycle is not function.cycle:
-                            total = cycle_totals[callee.cycle]
+                            total = cycle_totals[callee.cycle._idx]
                         else:
-                            total = function_totals[callee]
-                        call.ratio = ratio(call[event], total)
+                            total = function_totals[callee._idx]
+                        call.ratio = ratio(value, total)
                     else:
                         # Warnings here would only repeat those issued above.
                         call.ratio = 0.0
+        _warnings.flush()
 
     def integrate(self, outevent, inevent):
         """Propagate function time ratio along the function calls.
@@ -533,13 +762,14 @@ class Profile(Object):
 
         # Sanity checking
         assert outevent not in self
-        for function in self.functions.values():
-            assert outevent not in function
-            assert inevent in function
-            for call in function.calls.values():
-                assert outevent not in call
-                if call.callee_id != function.id:
-                    assert call.ratio is not None
+        if _VALIDATE:
+            for function in self.functions.values():
+                assert outevent not in function
+                assert inevent in function
+                for call in function.calls.values():
+                    assert outevent not in call
+                    if call.callee_id != function.id:
+                        assert call.ratio is not None
 
         # Aggregate the input for each cycle
         for cycle in self.cycles:
@@ -558,19 +788,53 @@ class Profile(Object):
     def _integrate_function(self, function, outevent, inevent):
         if function.cycle is not None:
             return self._integrate_cycle(function.cycle, outevent, inevent)
-        else:
-            if outevent not in function:
-                total = function[inevent]
-                for call in function.calls.values():
-                    if call.callee_id != function.id:
-                        total += self._integrate_call(call, outevent, inevent)
-                function[outevent] = total
+        if outevent in function:
             return function[outevent]
 
+        # Depth-first post-order traversal with an explicit stack, so deep
+        # call chains do not hit the interpreter recursion limit.  Each frame
+        # holds the function, the calls still to visit, the running total,
+        # and the call through which the function was entered.
+        work = [[function, iter(function.calls.values()), function[inevent], None]]
+        while work:
+            frame = work[-1]
+            func, calls_iter = frame[0], frame[1]
+            descended = False
+            for call in calls_iter:
+                if call.callee_id == func.id:
+                    continue
+                if _VALIDATE:
+                    assert outevent not in call
+                    assert call.ratio is not None
+                callee = call.callee
+                if callee.cycle is not None:
+                    subtotal = call.ratio*self._integrate_cycle(callee.cycle, outevent, inevent)
+                elif outevent in callee:
+                    subtotal = call.ratio*callee[outevent]
+                else:
+                    # Unvisited callee: push a new frame for it
+                    work.append([callee, iter(callee.calls.values()), callee[inevent], call])
+                    descended = True
+                    break
+                call[outevent] = subtotal
+                frame[2] += subtotal
+            if descended:
+                continue
+            # All calls visited: record the total and propagate it upwards
+            work.pop()
+            func[outevent] = frame[2]
+            call = frame[3]
+            if call is not None:
+                subtotal = call.ratio*frame[2]
+                call[outevent] = subtotal
+                work[-1][2] += subtotal
+        return function[outevent]
+
     def _integrate_call(self, call, outevent, inevent):
-        assert outevent not in call
-        assert call.ratio is not None
-        callee = self.functions[call.callee_id]
+        if _VALIDATE:
+            assert outevent not in call
+            assert call.ratio is not None
+        callee = call.callee
         subtotal = call.ratio *self._integrate_function(callee, outevent, inevent)
         call[outevent] = subtotal
         return subtotal
@@ -583,18 +847,27 @@ class Profile(Object):
             for member in cycle.functions:
                 subtotal = member[inevent]
                 for call in member.calls.values():
-                    callee = self.functions[call.callee_id]
+                    callee = call.callee
                     if callee.cycle is not cycle:
                         subtotal += self._integrate_call(call, outevent, inevent)
                 total += subtotal
             cycle[outevent] = total
 
-            # Compute the time propagated to callers of this cycle
+            # Compute the time propagated to callers of this cycle.  Find the
+            # callers through the reverse-edge map instead of scanning the
+            # whole graph, but visit them in function insertion order so that
+            # the floating point accumulation matches a full scan.
+            edges_up = self._build_reverse_edges()
+            function_index = self._build_function_index()
+            caller_ids = set()
+            for member in cycle.functions:
+                caller_ids.update(edges_up.get(member.id, ()))
             callees = {}
-            for function in self.functions.values():
+            for caller_id in sorted(caller_ids, key=function_index.get):
+                function = self.functions[caller_id]
                 if function.cycle is not cycle:
                     for call in function.calls.values():
-                        callee = self.functions[call.callee_id]
+                        callee = call.callee
                         if callee.cycle is cycle:
                             try:
                                 callees[callee] += call.ratio
@@ -629,52 +902,40 @@ class Profile(Object):
 
         import heapq
         Q = []
-        Qd = {}
-        p = {}
         visited = set([function])
 
         ranks[function] = 0
         for call in function.calls.values():
             if call.callee_id != function.id:
-                callee = self.functions[call.callee_id]
+                callee = call.callee
                 if callee.cycle is cycle:
                     ranks[callee] = 1
-                    item = [ranks[callee], function, callee]
-                    heapq.heappush(Q, item)
-                    Qd[callee] = item
+                    heapq.heappush(Q, (ranks[callee], function, callee))
 
         while Q:
             cost, parent, member = heapq.heappop(Q)
             if member not in visited:
-                p[member]= parent
+                if cost > ranks[member]:
+                    # Stale entry superseded by a later relaxation
+                    continue
                 visited.add(member)
                 for call in member.calls.values():
                     if call.callee_id != member.id:
-                        callee = self.functions[call.callee_id]
+                        callee = call.callee
                         if callee.cycle is cycle:
-                            member_rank = ranks[member]
-                            rank = ranks.get(callee)
-                            if rank is not None:
-                                if rank > 1 + member_rank:
-                                    rank = 1 + member_rank
-                                    ranks[callee] = rank
-                                    Qd_callee = Qd[callee]
-                                    Qd_callee[0] = rank
-                                    Qd_callee[1] = member
-                                    heapq._siftdown(Q, 0, Q.index(Qd_callee))
-                            else:
-                                rank = 1 + member_rank
+                            rank = 1 + ranks[member]
+                            if callee not in ranks or rank < ranks[callee]:
+                                # Relax lazily: push a fresh entry rather than
+                                # fixing up the one already on the heap
                                 ranks[callee] = rank
-                                item = [rank, member, callee]
-                                heapq.heappush(Q, item)
-                                Qd[callee] = item
+                                heapq.heappush(Q, (rank, member, callee))
 
     def _call_ratios_cycle(self, cycle, function, ranks, call_ratios, visited):
         if function not in visited:
             visited.add(function)
             for call in function.calls.values():
                 if call.callee_id != function.id:
-                    callee = self.functions[call.callee_id]
+                    callee = call.callee
                     if callee.cycle is cycle:
                         if ranks[callee] > ranks[function]:
                             call_ratios[callee] = call_ratios.get(callee, 0.0) + call.ratio
@@ -685,7 +946,7 @@ class Profile(Object):
             partial = partial_ratio*function[inevent]
             for call in function.calls.values():
                 if call.callee_id != function.id:
-                    callee = self.functions[call.callee_id]
+                    callee = call.callee
                     if callee.cycle is not cycle:
                         assert outevent in call
                         partial += partial_ratio*call[outevent]
@@ -710,86 +971,138 @@ class Profile(Object):
         """Aggregate an event for the whole profile."""
 
         total = event.null()
+        event_slot = event.slot
         for function in self.functions.values():
-            try:
-                total = event.aggregate(total, function[event])
-            except UndefinedEvent:
+            events = function.events
+            value = events[event_slot] if events is not None else None
+            if value is None:
                 return
+            total = event.aggregate(total, value)
         self[event] = total
 
     def ratio(self, outevent, inevent):
         assert outevent not in self
         assert inevent in self
+        total = self[inevent]
+        inevent_slot = inevent.slot
         for function in self.functions.values():
-            assert outevent not in function
-            assert inevent in function
-            function[outevent] = ratio(function[inevent], self[inevent])
+            if _VALIDATE:
+                assert outevent not in function
+                assert inevent in function
+            function[outevent] = ratio(function.events[inevent_slot], total)
             for call in function.calls.values():
-                assert outevent not in call
-                if inevent in call:
-                    call[outevent] = ratio(call[inevent], self[inevent])
+                if _VALIDATE:
+                    assert outevent not in call
+                events = call.events
+                value = events[inevent_slot] if events is not None else None
+                if value is not None:
+                    call[outevent] = ratio(value, total)
         self[outevent] = 1.0
 
     def prune(self, node_thres, edge_thres, paths, color_nodes_by_selftime):
         """Prune the profile"""
+        self.prune_combined(node_thres, edge_thres, paths, color_nodes_by_selftime)
+
+    def prune_combined(self, node_thres, edge_thres, paths, color_nodes_by_selftime,
+                       root=None, depth=-1):
+        """Prune by thresholds and, when a root pattern is given, to the
+        subtree below it, rebuilding the function and call tables once
+        instead of once per stage.
+
+        Returns the ids matching the root pattern among the threshold
+        survivors, or None when no root was given.
+        """
 
         # compute the prune ratios
+        total_time_ratio_slot = TOTAL_TIME_RATIO.slot
         for function in self.functions.values():
-            try:
-                function.weight = function[TOTAL_TIME_RATIO]
-            except UndefinedEvent:
-                pass
+            function_ratio = function.events[total_time_ratio_slot]
+            if function_ratio is not None:
+                function.weight = function_ratio
 
             for call in function.calls.values():
-                callee = self.functions[call.callee_id]
+                callee = call.callee
 
-                if TOTAL_TIME_RATIO in call:
+                events = call.events
+                weight = events[total_time_ratio_slot] if events is not None else None
+                if weight is not None:
                     # handle exact cases first
-                    call.weight = call[TOTAL_TIME_RATIO]
+                    call.weight = weight
                 else:
-                    try:
+                    callee_ratio = callee.events[total_time_ratio_slot]
+                    if function_ratio is not None and callee_ratio is not None:
                         # make a safe estimate
-                        call.weight = min(function[TOTAL_TIME_RATIO], callee[TOTAL_TIME_RATIO])
-                    except UndefinedEvent:
-                        pass
-
-        # prune the nodes
-        for function_id in list(self.functions.keys()):
-            function = self.functions[function_id]
-            if function.weight is not None:
-                if function.weight < node_thres:
-                    del self.functions[function_id]
+                        call.weight = function_ratio if function_ratio < callee_ratio else callee_ratio
 
-        # prune file paths
-        for function_id in list(self.functions.keys()):
-            function = self.functions[function_id]
+        # select the nodes and file paths surviving the thresholds; the
+        # actual rebuild is deferred until the keep set is final
+        survivors = set()
+        for function_id, function in self.functions.items():
+            if function.weight is not None and function.weight < node_thres:
+                continue
             if paths and function.filename and not any(function.filename.startswith(path) for path in paths):
-                del self.functions[function_id]
+                continue
             elif paths and function.module and not any((function.module.find(path)>-1) for path in paths):
-                del self.functions[function_id]
-
-        # prune the edges
-        for function in self.functions.values():
-            for callee_id in list(function.calls.keys()):
-                call = function.calls[callee_id]
-                if callee_id not in self.functions or call.weight is not None and call.weight < edge_thres:
-                    del function.calls[callee_id]
+                continue
+            survivors.add(function_id)
 
         if color_nodes_by_selftime:
+            time_ratio_slot = TIME_RATIO.slot
             weights = []
-            for function in self.functions.values():
-                try:
-                    weights.append(function[TIME_RATIO])
-                except UndefinedEvent:
-                    pass
+            for function_id in survivors:
+                time_ratio = self.functions[function_id].events[time_ratio_slot]
+                if time_ratio is not None:
+                    weights.append(time_ratio)
             max_ratio = max(weights or [1])
 
             # apply rescaled weights for coloriung
-            for function in self.functions.values():
-                try:
-                    function.weight = function[TIME_RATIO] / max_ratio
-                except (ZeroDivisionError, UndefinedEvent):
-                    pass
+            if max_ratio:
+                for function_id in survivors:
+                    function = self.functions[function_id]
+                    time_ratio = function.events[time_ratio_slot]
+                    if time_ratio is not None:
+                        function.weight = time_ratio / max_ratio
+
+        root_ids = None
+        keep = survivors
+        if root is not None:
+            # resolve the pattern against the survivors, as a lookup on
+            # the threshold-pruned profile would
+            function_names = {self.functions[function_id].name: function_id
+                              for function_id in self.functions
+                              if function_id in survivors}
+            root_ids = [function_names[name]
+                        for name in fnmatch.filter(function_names.keys(), root)]
+            visited = set()
+            frontier = collections.deque((root_id, depth) for root_id in root_ids)
+            while frontier:
+                node, node_depth = frontier.popleft()
+                if node in visited:
+                    continue
+                visited.add(node)
+                if node_depth == 0:
+                    continue
+                for new_node, call in self.functions[node].calls.items():
+                    if (new_node not in visited and new_node in survivors
+                            and not (call.weight is not None and call.weight < edge_thres)):
+                        frontier.append((new_node, node_depth - 1))
+            keep = visited
+
+        # prune the nodes and edges in a single rebuild
+        functions = {}
+        for function_id, function in self.functions.items():
+            if function_id not in keep:
+                continue
+            function.calls = {
+                callee_id: call
+                for callee_id, call in function.calls.items()
+                if callee_id in keep and not (call.weight is not None and call.weight < edge_thres)
+            }
+            functions[function_id] = function
+        self.functions = functions
+        self._invalidate_derived_maps()
+
+        return root_ids
 
     def dump(self):
         for function in self.functions.values():
@@ -806,8 +1119,12 @@ class Profile(Object):
                 sys.stderr.write('  Function %s\n' % (function.name,))
 
     def _dump_events(self, events):
-        for event, value in events.items():
-            sys.stderr.write('    %s: %s\n' % (event.name, event.format(value)))
+        if events is None:
+            return
+        for event in Event._registry:
+            value = events[event.slot]
+            if value is not None:
+                sys.stderr.write('    %s: %s\n' % (event.name, event.format(value)))
 
 
 
@@ -819,24 +1136,39 @@ class Struct:
     """Masquerade a dictionary with a structure-like behavior."""
 
     def __init__(self, attrs = None):
-        if attrs is None:
-            attrs = {}
-        self.__dict__['_attrs'] = attrs
-
-    def __getattr__(self, name):
-        try:
-            return self._attrs[name]
-        except KeyError:
-            raise AttributeError(name)
-
-    def __setattr__(self, name, value):
-        self._attrs[name] = value
+        # Store the attributes straight in the instance dict, so that reads
+        # and writes use ordinary C-level attribute access instead of going
+        # through __getattr__/__setattr__ on every field.
+        if attrs is not None:
+            self.__dict__.update(attrs)
 
     def __str__(self):
-        return str(self._attrs)
+        return str(self.__dict__)
 
     def __repr__(self):
-        return repr(self._attrs)
+        return repr(self.__dict__)
+
+
+def _make_translator(pattern, field_types):
+    """Generate a translate function specialized for a compiled pattern.
+
+    The named groups and their types are fixed per pattern, so the generic
+    groupdict walk and per-field type lookup can be compiled away into
+    straight-line code."""
+
+    lines = ['def _translate(mo):', '    attrs = {}']
+    for name, index in pattern.groupindex.items():
+        conv = field_types.get(name)
+        if conv is None:
+            lines.append('    attrs[%r] = mo.group(%d)' % (name, index))
+        else:
+            lines.append('    v = mo.group(%d)' % index)
+            lines.append('    attrs[%r] = %s(v) if v is not None else None'
+                         % (name, conv.__name__))
+    lines.append('    return Struct(attrs)')
+    namespace = {'Struct': Struct, 'int': int, 'float': float}
+    exec('\n'.join(lines), namespace)
+    return namespace['_translate']
 
 
 class ParseError(Exception):
@@ -878,15 +1210,28 @@ class JsonParser(Parser):
 
     def parse(self):
 
-        obj = json.load(self.stream)
+        if ijson is not None and self.stream.seekable():
+            # Stream the events instead of materializing the whole document:
+            # each event is discarded before the next one is parsed.
+            version = next(ijson.items(self.stream, 'version'), None)
+            self.stream.seek(0)
+            fns = list(ijson.items(self.stream, 'functions.item'))
+            self.stream.seek(0)
+            events = ijson.items(self.stream, 'events.item')
+        else:
+            if orjson is not None:
+                obj = orjson.loads(self.stream.read())
+            else:
+                obj = json.load(self.stream)
+            version = obj['version']
+            fns = obj['functions']
+            events = obj['events']
 
-        assert obj['version'] == 0
+        assert version == 0
 
         profile = Profile()
         profile[SAMPLES] = 0
 
-        fns = obj['functions']
-
         for functionIndex in range(len(fns)):
             fn = fns[functionIndex]
             function = Function(functionIndex, fn['name'])
@@ -902,34 +1247,34 @@ class JsonParser(Parser):
             function.called = 0
             profile.add_function(function)
 
-        for event in obj['events']:
-            callchain = []
-
-            for functionIndex in event['callchain']:
-                function = profile.functions[functionIndex]
-                callchain.append(function)
-
-            # increment the call count of the first in the callchain
-            function = profile.functions[event['callchain'][0]]
-            function.called = function.called + 1
+        functions = profile.functions
+        total_samples = 0
+        # Accumulate edge costs in one flat (caller, callee) hash and
+        # materialize the Call objects afterwards, instead of probing each
+        # caller's call dict for every link of every event.
+        edge_cost = collections.defaultdict(int)
+        samples_slot = SAMPLES.slot
+        for event in events:
+            callchain = event['callchain']
 
             cost = event['cost'][0]
 
-            callee = callchain[0]
-            callee[SAMPLES] += cost
-            profile[SAMPLES] += cost
-
-            for caller in callchain[1:]:
-                try:
-                    call = caller.calls[callee.id]
-                except KeyError:
-                    call = Call(callee.id)
-                    call[SAMPLES2] = cost
-                    caller.add_call(call)
-                else:
-                    call[SAMPLES2] += cost
-
-                callee = caller
+            # increment the call count of the first in the callchain
+            callee_id = callchain[0]
+            callee = functions[callee_id]
+            callee.called += 1
+            callee.events[samples_slot] += cost
+            total_samples += cost
+
+            for caller_id in callchain[1:]:
+                edge_cost[(caller_id, callee_id)] += cost
+                callee_id = caller_id
+        profile[SAMPLES] = total_samples
+
+        # edge_cost iterates in first-seen order, so each caller gets its
+        # calls in the same order the events introduced them
+        for (caller_id, callee_id), cost in edge_cost.items():
+            functions[caller_id].add_call(Call.make(callee_id, SAMPLES2, cost))
 
         if False:
             profile.dump()
@@ -984,6 +1329,8 @@ XML_ELEMENT_START, XML_ELEMENT_END, XML_CHARACTER_DATA, XML_EOF = range(4)
 
 class XmlToken:
 
+    __slots__ = ('type', 'name_or_data', 'attrs', 'line', 'column')
+
     def __init__(self, type, name_or_data, attrs = None, line = None, column = None):
         assert type in (XML_ELEMENT_START, XML_ELEMENT_END, XML_CHARACTER_DATA, XML_EOF)
         self.type = type
@@ -1009,59 +1356,82 @@ class XmlTokenizer:
 
     def __init__(self, fp, skip_ws = True):
         self.fp = fp
-        self.tokens = []
-        self.index = 0
+        # Pending tokens for the current parse chunk; consumed tokens are
+        # popped off immediately instead of being kept behind an index.
+        self.tokens = collections.deque()
+        # Free list of retired tokens (see XmlParser.consume): large
+        # documents produce millions of short-lived XmlToken objects.
+        self._free = []
         self.final = False
         self.skip_ws = skip_ws
 
         self.character_pos = 0, 0
-        self.character_data = ''
+        # Pending character data chunks, joined lazily: appending to a list
+        # is linear, while repeated string concatenation is quadratic.
+        self.character_data = []
 
         self.parser = xml.parsers.expat.ParserCreate()
+        # Let expat coalesce adjacent text chunks in C, so the handler is
+        # typically invoked once per text node.
+        self.parser.buffer_text = True
         self.parser.StartElementHandler  = self.handle_element_start
         self.parser.EndElementHandler    = self.handle_element_end
         self.parser.CharacterDataHandler = self.handle_character_data
 
+    def _make_token(self, type, name_or_data, attrs, line, column):
+        try:
+            token = self._free.pop()
+        except IndexError:
+            token = XmlToken.__new__(XmlToken)
+        token.type = type
+        token.name_or_data = name_or_data
+        token.attrs = attrs
+        token.line = line
+        token.column = column
+        return token
+
+    def recycle(self, token):
+        self._free.append(token)
+
     def handle_element_start(self, name, attributes):
         self.finish_character_data()
         line, column = self.pos()
-        token = XmlToken(XML_ELEMENT_START, name, attributes, line, column)
+        token = self._make_token(XML_ELEMENT_START, name, attributes, line, column)
         self.tokens.append(token)
 
     def handle_element_end(self, name):
         self.finish_character_data()
         line, column = self.pos()
-        token = XmlToken(XML_ELEMENT_END, name, None, line, column)
+        token = self._make_token(XML_ELEMENT_END, name, None, line, column)
         self.tokens.append(token)
 
     def handle_character_data(self, data):
         if not self.character_data:
             self.character_pos = self.pos()
-        self.character_data += data
+        self.character_data.append(data)
 
     def finish_character_data(self):
         if self.character_data:
-            if not self.skip_ws or not self.character_data.isspace():
+            character_data = ''.join(self.character_data)
+            if not self.skip_ws or not character_data.isspace():
                 line, column = self.character_pos
-                token = XmlToken(XML_CHARACTER_DATA, self.character_data, None, line, column)
+                token = self._make_token(XML_CHARACTER_DATA, character_data, None, line, column)
                 self.tokens.append(token)
-            self.character_data = ''
+            self.character_data = []
 
     def next(self):
-        size = 16*1024
-        while self.index >= len(self.tokens) and not self.final:
-            self.tokens = []
-            self.index = 0
+        # 1 MiB chunks: few Python-to-expat crossings while still keeping
+        # token delivery incremental
+        size = 1024*1024
+        tokens = self.tokens
+        while not tokens and not self.final:
             data = self.fp.read(size)
             self.final = len(data) < size
             self.parser.Parse(data, self.final)
-        if self.index >= len(self.tokens):
+        if not tokens:
             line, column = self.pos()
-            token = XmlToken(XML_EOF, None, None, line, column)
-        else:
-            token = self.tokens[self.index]
-            self.index += 1
-        return token
+            return self._make_token(XML_EOF, None, None, line, column)
+        return tokens.popleft()
 
     def pos(self):
         return self.parser.CurrentLineNumber, self.parser.CurrentColumnNumber
@@ -1084,10 +1454,16 @@ class XmlParser(Parser):
     def __init__(self, fp):
         Parser.__init__(self)
         self.tokenizer = XmlTokenizer(fp)
+        self.token = None
         self.consume()
 
     def consume(self):
+        # the previous token cannot be reached anymore; let the tokenizer
+        # reuse it
+        token = self.token
         self.token = self.tokenizer.next()
+        if token is not None:
+            self.tokenizer.recycle(token)
 
     def match_element_start(self, name):
         return self.token.type == XML_ELEMENT_START and self.token.name_or_data == name
@@ -1140,31 +1516,48 @@ class GprofParser(Parser):
         self.fp = fp
         self.functions = {}
         self.cycles = {}
+        # Read the whole report up front: the line endings are stripped in
+        # bulk, avoiding a Python-level readline/rstrip call per line.  A
+        # plain split keeps form feeds (which delimit the call graph) as
+        # line content, unlike splitlines().
+        self._lines = fp.read().replace('\r\n', '\n').split('\n')
+        self._lineno = 0
 
     def readline(self):
-        line = self.fp.readline()
-        if not line:
+        try:
+            line = self._lines[self._lineno]
+        except IndexError:
             sys.stderr.write('error: unexpected end of file\n')
             sys.exit(1)
-        line = line.rstrip('\r\n')
+        self._lineno += 1
         return line
 
-    _int_re = re.compile(r'^\d+$')
-    _float_re = re.compile(r'^\d+\.\d+$')
+    # The named groups of the call graph regexps below have fixed types, so
+    # the conversions can be table-driven instead of sniffing each value with
+    # int/float regexps.  Groups absent from this table (i.e. name) are kept
+    # as strings.
+    _field_types = {
+        'index': int,
+        'percentage_time': float,
+        'self': float,
+        'descendants': float,
+        'called': int,
+        'called_self': int,
+        'called_total': int,
+        'cycle': int,
+    }
+
+    # Specialized translators, generated lazily per call graph pattern.
+    _translators = {}
 
     def translate(self, mo):
         """Extract a structure from a match object, while translating the types in the process."""
-        attrs = {}
-        groupdict = mo.groupdict()
-        for name, value in groupdict.items():
-            if value is None:
-                value = None
-            elif self._int_re.match(value):
-                value = int(value)
-            elif self._float_re.match(value):
-                value = float(value)
-            attrs[name] = (value)
-        return Struct(attrs)
+        try:
+            translator = self._translators[mo.re]
+        except KeyError:
+            translator = _make_translator(mo.re, self._field_types)
+            self._translators[mo.re] = translator
+        return translator(mo)
 
     _cg_header_re = re.compile(
         # original gprof header
@@ -1225,24 +1618,35 @@ class GprofParser(Parser):
 
     _cg_sep_re = re.compile(r'^--+$')
 
+    # Parent/child lines and ignorable lines combined in a single
+    # alternation, so each line is scanned once instead of twice.  The
+    # parent pattern comes first and so keeps its priority; a match on the
+    # trailing branch means the line should be skipped.
+    _cg_parent_or_ignore_re = re.compile(
+        _cg_parent_re.pattern + '|(?P<ignore>' + _cg_ignore_re.pattern + ')'
+    )
+
     def parse_function_entry(self, lines):
         parents = []
         children = []
 
+        # consume the lines through an index: list.pop(0) is linear, which
+        # made long entries quadratic
+        lineno = 0
+        nlines = len(lines)
         while True:
-            if not lines:
+            if lineno == nlines:
                 sys.stderr.write('warning: unexpected end of entry\n')
-            line = lines.pop(0)
+            line = lines[lineno]
+            lineno += 1
             if line.startswith('['):
                 break
 
             # read function parent line
-            mo = self._cg_parent_re.match(line)
+            mo = self._cg_parent_or_ignore_re.match(line)
             if not mo:
-                if self._cg_ignore_re.match(line):
-                    continue
                 sys.stderr.write('warning: unrecognized call graph entry: %r\n' % line)
-            else:
+            elif mo.group('ignore') is None:
                 parent = self.translate(mo)
                 parents.append(parent)
 
@@ -1254,16 +1658,15 @@ class GprofParser(Parser):
         else:
             function = self.translate(mo)
 
-        while lines:
-            line = lines.pop(0)
+        while lineno < nlines:
+            line = lines[lineno]
+            lineno += 1
 
             # read function subroutine line
-            mo = self._cg_child_re.match(line)
+            mo = self._cg_parent_or_ignore_re.match(line)
             if not mo:
-                if self._cg_ignore_re.match(line):
-                    continue
                 sys.stderr.write('warning: unrecognized call graph entry: %r\n' % line)
-            else:
+            elif mo.group('ignore') is None:
                 child = self.translate(mo)
                 children.append(child)
 
@@ -1324,6 +1727,8 @@ class GprofParser(Parser):
     def parse(self):
         self.parse_cg()
         self.fp.close()
+        # release the raw report text before building the profile
+        self._lines = []
 
         profile = Profile()
         profile[TIME] = 0.0
@@ -1413,31 +1818,32 @@ class AXEParser(Parser):
         self.fp = fp
         self.functions = {}
         self.cycles = {}
+        # Bulk-read the report, as in GprofParser.
+        self._lines = fp.read().replace('\r\n', '\n').split('\n')
+        self._lineno = 0
 
     def readline(self):
-        line = self.fp.readline()
-        if not line:
+        try:
+            line = self._lines[self._lineno]
+        except IndexError:
             sys.stderr.write('error: unexpected end of file\n')
             sys.exit(1)
-        line = line.rstrip('\r\n')
+        self._lineno += 1
         return line
 
-    _int_re = re.compile(r'^\d+$')
-    _float_re = re.compile(r'^\d+\.\d+$')
+    # Same table-driven field conversion as GprofParser; the named groups
+    # here are a subset of the gprof ones.
+    _field_types = GprofParser._field_types
+    _translators = {}
 
     def translate(self, mo):
         """Extract a structure from a match object, while translating the types in the process."""
-        attrs = {}
-        groupdict = mo.groupdict()
-        for name, value in groupdict.items():
-            if value is None:
-                value = None
-            elif self._int_re.match(value):
-                value = int(value)
-            elif self._float_re.match(value):
-                value = float(value)
-            attrs[name] = (value)
-        return Struct(attrs)
+        try:
+            translator = self._translators[mo.re]
+        except KeyError:
+            translator = _make_translator(mo.re, self._field_types)
+            self._translators[mo.re] = translator
+        return translator(mo)
 
     _cg_header_re = re.compile(
         '^Index |'
@@ -1491,11 +1897,15 @@ class AXEParser(Parser):
         parents = []
         children = []
 
+        # index-based consumption, as in GprofParser.parse_function_entry
+        lineno = 0
+        nlines = len(lines)
         while True:
-            if not lines:
+            if lineno == nlines:
                 sys.stderr.write('warning: unexpected end of entry\n')
                 return
-            line = lines.pop(0)
+            line = lines[lineno]
+            lineno += 1
             if line.startswith('['):
                 break
 
@@ -1516,8 +1926,9 @@ class AXEParser(Parser):
         else:
             function = self.translate(mo)
 
-        while lines:
-            line = lines.pop(0)
+        while lineno < nlines:
+            line = lines[lineno]
+            lineno += 1
 
             # read function subroutine line
             mo = self._cg_child_re.match(line)
@@ -1538,11 +1949,14 @@ class AXEParser(Parser):
 
         # Process the parents that were not there in gprof format.
         parents = []
+        lineno = 0
+        nlines = len(lines)
         while True:
-            if not lines:
+            if lineno == nlines:
                 sys.stderr.write('warning: unexpected end of cycle entry\n')
                 return
-            line = lines.pop(0)
+            line = lines[lineno]
+            lineno += 1
             if line.startswith('['):
                 break
             mo = self._cg_parent_re.match(line)
@@ -1562,7 +1976,7 @@ class AXEParser(Parser):
 
         # read cycle member lines
         cycle.functions = []
-        for line in lines[1:]:
+        for line in lines[lineno + 1:]:
             mo = self._cg_cycle_member_re.match(line)
             if not mo:
                 sys.stderr.write('warning: unrecognized call graph entry (5): %r\n' % line)
@@ -1602,6 +2016,8 @@ class AXEParser(Parser):
         sys.stderr.write('warning: for axe format, edge weights are unreliable estimates derived from function total times.\n')
         self.parse_cg()
         self.fp.close()
+        # release the raw report text, as in GprofParser
+        self._lines = []
 
         profile = Profile()
         profile[TIME] = 0.0
@@ -1673,8 +2089,6 @@ class CallgrindParser(LineParser):
     - https://valgrind.org/docs/manual/cl-format.html
     """
 
-    _call_re = re.compile(r'^calls=\s*(\d+)\s+((\d+|\+\d+|-\d+|\*)\s+)+$')
-
     def __init__(self, infile):
         LineParser.__init__(self, infile)
 
@@ -1694,6 +2108,12 @@ class CallgrindParser(LineParser):
         self.profile = Profile()
         self.profile[SAMPLES] = 0
 
+        # single-slot caches for get_function/get_callee
+        self._last_function_key = None
+        self._last_function = None
+        self._last_callee_key = None
+        self._last_callee = None
+
     def parse(self):
         # read lookahead
         self.readline()
@@ -1772,24 +2192,47 @@ class CallgrindParser(LineParser):
         return True
 
     def parse_body_line(self):
+        # the first character pins down the only handler that can accept
+        # the line; unmapped characters fall back to the probe chain
+        handler = self._body_line_dispatch.get(self.lookahead()[:1])
+        if handler is not None:
+            return handler(self)
         return \
             self.parse_empty() or \
             self.parse_comment() or \
             self.parse_cost_line() or \
-            self.parse_position_spec() or \
-            self.parse_association_spec()
+            self.parse_spec_line()
 
-    __subpos_re = r'(0x[0-9a-fA-F]+|\d+|\+\d+|-\d+|\*)'
-    _cost_re = re.compile(r'^' +
-        __subpos_re + r'( +' + __subpos_re + r')*' +
-        r'( +\d+)*' +
-    '$')
+    _hex_digits = frozenset('0123456789abcdefABCDEF')
+
+    @classmethod
+    def _is_cost_token(cls, token):
+        # a subposition: hex number, decimal number, relative +/- number,
+        # or '*'; the trailing event counts are plain decimal numbers and
+        # thus also accepted
+        if token.isdigit() or token == '*':
+            return True
+        if token[0] in '+-':
+            return token[1:].isdigit()
+        if token[:2] == '0x' and len(token) > 2:
+            return cls._hex_digits.issuperset(token[2:])
+        return False
+
+    # characters a cost line can start with; everything else is rejected
+    # before even splitting the line
+    _cost_first = frozenset('0123456789+-*')
 
     def parse_cost_line(self, calls=None):
+        # Tokenize and classify linearly instead of recognizing the line
+        # with a nested-quantifier regex prone to heavy backtracking.
         line = self.lookahead().rstrip()
-        mo = self._cost_re.match(line)
-        if not mo:
+        if not line or line[0] not in self._cost_first:
             return False
+        values = line.split()
+        is_cost_token = self._is_cost_token
+        for value in values:
+            if not is_cost_token(value):
+                return False
 
         function = self.get_function()
 
@@ -1802,12 +2245,15 @@ class CallgrindParser(LineParser):
             except KeyError:
                 pass
 
-        values = line.split()
         assert len(values) <= self.num_positions + self.num_events
 
         positions = values[0 : self.num_positions]
-        events = values[self.num_positions : ]
-        events += ['0']*(self.num_events - len(events))
+        # only the first event is ever consumed; skip converting (and
+        # zero-padding) the rest
+        if len(values) > self.num_positions:
+            first_event = float(values[self.num_positions])
+        else:
+            first_event = 0.0
 
         for i in range(self.num_positions):
             position = positions[i]
@@ -1821,45 +2267,33 @@ class CallgrindParser(LineParser):
                 position = int(position)
             self.last_positions[i] = position
 
-        events = [float(event) for event in events]
-
         if calls is None:
-            function[SAMPLES] += events[0]
-            self.profile[SAMPLES] += events[0]
+            function[SAMPLES] += first_event
+            self.profile[SAMPLES] += first_event
         else:
             callee = self.get_callee()
             callee.called += calls
 
-            try:
-                call = function.calls[callee.id]
-            except KeyError:
-                call = Call(callee.id)
-                call[CALLS] = calls
-                call[SAMPLES2] = events[0]
-                function.add_call(call)
+            function_calls = function.calls
+            call = function_calls.get(callee.id)
+            if call is None:
+                call = Call.make(callee.id, CALLS, calls)
+                call[SAMPLES2] = first_event
+                function_calls[callee.id] = call
             else:
                 call[CALLS] += calls
-                call[SAMPLES2] += events[0]
+                call[SAMPLES2] += first_event
 
         self.consume()
         return True
 
-    def parse_association_spec(self):
-        line = self.lookahead()
-        if not line.startswith('calls='):
-            return False
-
-        _, values = line.split('=', 1)
-        values = values.strip().split()
-        calls = int(values[0])
-        call_position = values[1:]
-        self.consume()
-
-        self.parse_cost_line(calls)
-
-        return True
-
-    _position_re = re.compile(r'^(?P<position>[cj]?(?:ob|fl|fi|fe|fn))=\s*(?:\((?P<id>\d+)\))?(?:\s*(?P<name>.+))?')
+    # position specs, 'calls=' association specs and jump specs merged
+    # into a single alternation, so a header line is recognized with one
+    # match instead of a probe sequence
+    _spec_re = re.compile(
+        r'^(?:(?P<position>[cj]?(?:ob|fl|fi|fe|fn))=\s*(?:\((?P<id>\d+)\))?(?:\s*(?P<name>.+))?'
+        r'|(?P<assoc>calls=)(?P<avalues>[^\n]*)'
+        r'|(?P<jump>jump=|jcnd=))')
 
     _position_table_map = {
         'ob': 'ob',
@@ -1889,26 +2323,39 @@ class CallgrindParser(LineParser):
         'jfi': 'jfi',
     }
 
-    def parse_position_spec(self):
-        line = self.lookahead()
+    # position -> (table, mapped position), fused so a position line costs
+    # one dict lookup instead of two
+    _position_combined = {}
+    for _key in _position_map:
+        _position_combined[sys.intern(_key)] = (_position_table_map[_key], _position_map[_key])
+    del _key
+
+    def parse_spec_line(self):
+        mo = self._spec_re.match(self.lookahead())
+        if mo is None:
+            return False
 
-        if line.startswith('jump=') or line.startswith('jcnd='):
+        position = mo.group('position')
+        if position is not None:
+            id, name = mo.group('id', 'name')
+            table, mapped = self._position_combined[position]
+            if id:
+                if name:
+                    self.position_ids[(table, id)] = name
+                else:
+                    name = self.position_ids.get((table, id), '')
+            self.positions[mapped] = name
             self.consume()
             return True
 
-        mo = self._position_re.match(line)
-        if not mo:
-            return False
-
-        position, id, name = mo.groups()
-        if id:
-            table = self._position_table_map[position]
-            if name:
-                self.position_ids[(table, id)] = name
-            else:
-                name = self.position_ids.get((table, id), '')
-        self.positions[self._position_map[position]] = name
+        if mo.group('assoc') is not None:
+            values = mo.group('avalues').strip().split()
+            calls = int(values[0])
+            self.consume()
+            self.parse_cost_line(calls)
+            return True
 
+        # jump= / jcnd= specifications are ignored
         self.consume()
         return True
 
@@ -1916,7 +2363,8 @@ class CallgrindParser(LineParser):
         if self.eof():
             return False
         line = self.lookahead()
-        if line.strip():
+        # isspace scans without allocating the stripped copy
+        if line and not line.isspace():
             return False
         self.consume()
         return True
@@ -1928,6 +2376,17 @@ class CallgrindParser(LineParser):
         self.consume()
         return True
 
+    # first-character dispatch for parse_body_line; built here so the
+    # handlers above are already bound in the class namespace
+    _body_line_dispatch = {}
+    for _c in '0123456789+-*':
+        _body_line_dispatch[_c] = parse_cost_line
+    for _c in 'ofjc':
+        _body_line_dispatch[_c] = parse_spec_line
+    _body_line_dispatch['#'] = parse_comment
+    _body_line_dispatch[''] = parse_empty
+    del _c
+
     _key_re = re.compile(r'^(\w+):')
 
     def parse_key(self, key):
@@ -1958,23 +2417,37 @@ class CallgrindParser(LineParser):
         except KeyError:
             function = Function(id, name)
             if module:
-                function.module = os.path.basename(module)
+                function.module = _basename(module)
             function[SAMPLES] = 0
             function.called = 0
             self.profile.add_function(function)
         return function
 
     def get_function(self):
-        module = self.positions.get('ob', '')
-        filename = self.positions.get('fl', '')
-        function = self.positions.get('fn', '')
-        return self.make_function(module, filename, function)
+        # consecutive cost lines usually belong to the same function, so a
+        # single-slot cache spares the id lookup in make_function
+        positions = self.positions
+        key = (positions.get('ob', ''),
+               positions.get('fl', ''),
+               positions.get('fn', ''))
+        if key == self._last_function_key:
+            return self._last_function
+        function = self.make_function(*key)
+        self._last_function_key = key
+        self._last_function = function
+        return function
 
     def get_callee(self):
-        module = self.positions.get('cob', '')
-        filename = self.positions.get('cfi', '')
-        function = self.positions.get('cfn', '')
-        return self.make_function(module, filename, function)
+        positions = self.positions
+        key = (positions.get('cob', ''),
+               positions.get('cfi', ''),
+               positions.get('cfn', ''))
+        if key == self._last_callee_key:
+            return self._last_callee
+        function = self.make_function(*key)
+        self._last_callee_key = key
+        self._last_callee = function
+        return function
 
     def readline(self):
         # Override LineParser.readline to ignore comment lines
@@ -1996,6 +2469,9 @@ class PerfParser(LineParser):
     def __init__(self, infile):
         LineParser.__init__(self, infile)
         self.profile = Profile()
+        # symbol -> name with the program counter suffix stripped
+        self._name_cache = {}
+        self._event_counter = 0
 
     def readline(self):
         # Override LineParser.readline to ignore comment lines
@@ -2018,21 +2494,7 @@ class PerfParser(LineParser):
         profile.find_cycles()
         profile.ratio(TIME_RATIO, SAMPLES)
         profile.call_ratios(SAMPLES2)
-        if totalMethod == "callratios":
-            # Heuristic approach.  TOTAL_SAMPLES is unused.
-            profile.integrate(TOTAL_TIME_RATIO, TIME_RATIO)
-        elif totalMethod == "callstacks":
-            # Use the actual call chains for functions.
-            profile[TOTAL_SAMPLES] = profile[SAMPLES]
-            profile.ratio(TOTAL_TIME_RATIO, TOTAL_SAMPLES)
-            # Then propagate that total time to the calls.
-            for function in profile.functions.values():
-                for call in function.calls.values():
-                    if call.ratio is not None:
-                        callee = profile.functions[call.callee_id]
-                        call[TOTAL_TIME_RATIO] = call.ratio * callee[TOTAL_TIME_RATIO]
-        else:
-            assert False
+        integrate_total(profile)
 
         return profile
 
@@ -2052,30 +2514,37 @@ class PerfParser(LineParser):
         self.profile[SAMPLES] += 1
 
         for caller in callchain[1:]:
-            try:
-                call = caller.calls[callee.id]
-            except KeyError:
-                call = Call(callee.id)
-                call[SAMPLES2] = 1
-                caller.add_call(call)
+            # single dict probe per frame; add_call's duplicate check is
+            # redundant after the miss
+            caller_calls = caller.calls
+            call = caller_calls.get(callee.id)
+            if call is None:
+                call = Call.make(callee.id, SAMPLES2, 1)
+                caller_calls[callee.id] = call
             else:
                 call[SAMPLES2] += 1
 
             callee = caller
 
-        # Increment TOTAL_SAMPLES only once on each function.
-        stack = set(callchain)
-        for function in stack:
-            function[TOTAL_SAMPLES] += 1
-
     def parse_callchain(self):
         callchain = []
-        while self.lookahead():
-            function = self.parse_call()
+        append = callchain.append
+        lookahead = self.lookahead
+        parse_call = self.parse_call
+        # Increment TOTAL_SAMPLES only once on each function.  Marking
+        # visited functions with the current event number avoids
+        # allocating a deduplication set for every event.
+        self._event_counter += 1
+        eid = self._event_counter
+        while lookahead():
+            function = parse_call()
             if function is None:
                 break
-            callchain.append(function)
-        if self.lookahead() == '':
+            append(function)
+            if function._last_eid != eid:
+                function._last_eid = eid
+                function[TOTAL_SAMPLES] += 1
+        if lookahead() == '':
             self.consume()
         return callchain
 
@@ -2091,9 +2560,15 @@ class PerfParser(LineParser):
 
         function_name = mo.group('symbol')
 
-        # If present, amputate program counter from function name.
+        # If present, amputate program counter from function name.  The
+        # same symbols recur across millions of frames, so cache the
+        # cleaned names.
         if function_name:
-            function_name = re.sub(self.addr2_re, '', function_name)
+            cleaned = self._name_cache.get(function_name)
+            if cleaned is None:
+                cleaned = self.addr2_re.sub('', function_name)
+                self._name_cache[function_name] = cleaned
+            function_name = cleaned
 
         if not function_name or function_name == '[unknown]':
             function_name = mo.group('address')
@@ -2106,7 +2581,7 @@ class PerfParser(LineParser):
             function = self.profile.functions[function_id]
         except KeyError:
             function = Function(function_id, function_name)
-            function.module = os.path.basename(module)
+            function.module = _basename(module)
             function[SAMPLES] = 0
             function[TOTAL_SAMPLES] = 0
             self.profile.add_function(function)
@@ -2134,6 +2609,7 @@ class OprofileParser(LineParser):
         LineParser.__init__(self, infile)
         self.entries = {}
         self.entry_re = None
+        self._entry_match = None
 
     def add_entry(self, callers, function, callees):
         try:
@@ -2147,10 +2623,10 @@ class OprofileParser(LineParser):
             self.update_subentries_dict(callees_total, callees)
 
     def update_subentries_dict(self, totals, partials):
+        totals_get = totals.get
         for partial in partials.values():
-            try:
-                total = totals[partial.id]
-            except KeyError:
+            total = totals_get(partial.id)
+            if total is None:
                 totals[partial.id] = partial
             else:
                 total.samples += partial.samples
@@ -2176,9 +2652,9 @@ class OprofileParser(LineParser):
             profile[SAMPLES] += _function.samples
 
             if _function.application:
-                function.process = os.path.basename(_function.application)
+                function.process = _basename(_function.application)
             if _function.image:
-                function.module = os.path.basename(_function.image)
+                function.module = _basename(_function.image)
 
             total_callee_samples = 0
             for _callee in _callees.values():
@@ -2206,6 +2682,15 @@ class OprofileParser(LineParser):
         fields = re.split(r'\s\s+', line)
         entry_re = r'^\s*' + r'\s+'.join([self._fields_re[field] for field in fields]) + r'(?P<self>\s+\[self\])?$'
         self.entry_re = re.compile(entry_re)
+        # bound match method, saving two attribute lookups per subentry
+        self._entry_match = self.entry_re.match
+        # which optional columns the header declared; checked once here so
+        # parse_subentry can use direct group reads instead of groupdict
+        groupindex = self.entry_re.groupindex
+        self._has_source = 'source' in groupindex
+        self._has_image = 'image' in groupindex
+        self._has_application = 'application' in groupindex
+        self._has_symbol = 'symbol' in groupindex
         self.skip_separator()
 
     def parse_entry(self):
@@ -2227,13 +2712,12 @@ class OprofileParser(LineParser):
     def parse_subentry(self):
         entry = Struct()
         line = self.consume()
-        mo = self.entry_re.match(line)
+        mo = self._entry_match(line)
         if not mo:
             raise ParseError('failed to parse', line)
-        fields = mo.groupdict()
         entry.samples = int(mo.group(1))
-        if 'source' in fields and fields['source'] != '(no location information)':
-            source = fields['source']
+        source = mo.group('source') if self._has_source else None
+        if source is not None and source != '(no location information)':
             filename, lineno = source.split(':')
             entry.filename = filename
             entry.lineno = int(lineno)
@@ -2241,16 +2725,17 @@ class OprofileParser(LineParser):
             source = ''
             entry.filename = None
             entry.lineno = None
-        entry.image = fields.get('image', '')
-        entry.application = fields.get('application', '')
-        if 'symbol' in fields and fields['symbol'] != '(no symbols)':
-            entry.symbol = fields['symbol']
+        entry.image = mo.group('image') if self._has_image else ''
+        entry.application = mo.group('application') if self._has_application else ''
+        symbol = mo.group('symbol') if self._has_symbol else ''
+        if symbol != '(no symbols)':
+            entry.symbol = symbol
         else:
             entry.symbol = ''
         if entry.symbol.startswith('"') and entry.symbol.endswith('"'):
             entry.symbol = entry.symbol[1:-1]
         entry.id = ':'.join((entry.application, entry.image, source, entry.symbol))
-        entry.self = fields.get('self', None) != None
+        entry.self = mo.group('self') is not None
         if entry.self:
             entry.id += ':self'
         if entry.symbol:
@@ -2323,19 +2808,26 @@ class HProfParser(LineParser):
             last = None
 
             for func, file, line in trace:
-                if not func in functions:
+                function = functions.get(func)
+                if function is None:
                     function = Function(func, func)
                     function[SAMPLES] = 0
                     profile.add_function(function)
                     functions[func] = function
 
-                function = functions[func]
                 # allocate time to the deepest method in the trace
                 if not last:
                     function[SAMPLES] += mtime
                     profile[SAMPLES] += mtime
                 else:
-                    c = function.get_call(last)
+                    calls = function.calls
+                    c = calls.get(last)
+                    if c is None:
+                        c = Call(last)
+                        c[SAMPLES] = 0
+                        c[SAMPLES2] = 0
+                        c[CALLS] = 0
+                        calls[last] = c
                     c[SAMPLES2] += mtime
 
                 last = func
@@ -2359,16 +2851,19 @@ class HProfParser(LineParser):
         tid = mo.group(1)
         last = None
         trace = []
-
-        while self.lookahead().startswith('\t'):
-            l = self.consume()
-            match = self.trace_re.search(l)
+        append = trace.append
+        lookahead = self.lookahead
+        consume = self.consume
+        search = self.trace_re.search
+
+        while lookahead().startswith('\t'):
+            l = consume()
+            match = search(l)
             if not match:
                 #sys.stderr.write('Invalid line: %s\n' % l)
                 break
             else:
-                function_name, file, line = match.groups()
-                trace += [(function_name, file, line)]
+                append(match.groups())
 
         self.traces[int(tid)] = trace
 
@@ -2480,12 +2975,11 @@ class SysprofParser(XmlParser):
             function = profile.functions[caller_id]
 
             samples = node['self']
-            try:
-                call = function.calls[callee_id]
-            except KeyError:
-                call = Call(callee_id)
-                call[SAMPLES2] = samples
-                function.add_call(call)
+            function_calls = function.calls
+            call = function_calls.get(callee_id)
+            if call is None:
+                call = Call.make(callee_id, SAMPLES2, samples)
+                function_calls[callee_id] = call
             else:
                 call[SAMPLES2] += samples
 
@@ -2543,33 +3037,40 @@ class XPerfParser(Parser):
             name = row[column]
             assert name not in self.column
             self.column[name] = column
+        # only these columns are ever consumed; resolve their indices once
+        # so parse_row does not convert every cell of every row
+        column = self.column
+        self._process_col = column['Process Name']
+        self._module_col = column['Module']
+        self._function_col = column['Function']
+        self._weight_col = column['Weight']
+        self._count_col = column['Count']
+        self._stack_col = column['Stack']
+
+    @staticmethod
+    def _to_number(value):
+        try:
+            return int(value)
+        except ValueError:
+            try:
+                return float(value)
+            except ValueError:
+                return value
 
     def parse_row(self, row):
-        fields = {}
-        for name, column in self.column.items():
-            value = row[column]
-            for factory in int, float:
-                try:
-                    value = factory(value)
-                except ValueError:
-                    pass
-                else:
-                    break
-            fields[name] = value
-
-        process = fields['Process Name']
-        symbol = fields['Module'] + '!' + fields['Function']
-        weight = fields['Weight']
-        count = fields['Count']
-
+        process = row[self._process_col]
         if process == 'Idle':
             return
 
+        symbol = row[self._module_col] + '!' + row[self._function_col]
+        weight = self._to_number(row[self._weight_col])
+        count = self._to_number(row[self._count_col])
+
         function = self.get_function(process, symbol)
         function[SAMPLES] += weight * count
         self.profile[SAMPLES] += weight * count
 
-        stack = fields['Stack']
+        stack = row[self._stack_col]
         if stack != '?':
             stack = stack.split('/')
             assert stack[0] == '[Root]'
@@ -2580,12 +3081,11 @@ class XPerfParser(Parser):
             for symbol in stack[1:]:
                 callee = self.get_function(process, symbol)
                 if caller is not None:
-                    try:
-                        call = caller.calls[callee.id]
-                    except KeyError:
-                        call = Call(callee.id)
-                        call[SAMPLES2] = count
-                        caller.add_call(call)
+                    caller_calls = caller.calls
+                    call = caller_calls.get(callee.id)
+                    if call is None:
+                        call = Call.make(callee.id, SAMPLES2, count)
+                        caller_calls[callee.id] = call
                     else:
                         call[SAMPLES2] += count
                 caller = callee
@@ -2643,11 +3143,14 @@ class SleepyParser(Parser):
                 name = database_name
                 break
 
-        return self.database.open(name, 'r')
+        # batch the UTF-8 decoding at C level instead of decoding each
+        # line separately
+        return io.TextIOWrapper(self.database.open(name, 'r'),
+                                encoding='UTF-8', newline='')
 
     def parse_symbols(self):
         for line in self.openEntry('Symbols.txt'):
-            line = line.decode('UTF-8').rstrip('\r\n')
+            line = line.rstrip('\r\n')
 
             mo = self._symbol_re.match(line)
             if mo:
@@ -2667,8 +3170,6 @@ class SleepyParser(Parser):
 
     def parse_callstacks(self):
         for line in self.openEntry('Callstacks.txt'):
-            line = line.decode('UTF-8').rstrip('\r\n')
-
             fields = line.split()
             samples = float(fields[0])
             callstack = fields[1:]
@@ -2681,12 +3182,11 @@ class SleepyParser(Parser):
             self.profile[SAMPLES] += samples
 
             for caller in callstack[1:]:
-                try:
-                    call = caller.calls[callee.id]
-                except KeyError:
-                    call = Call(callee.id)
-                    call[SAMPLES2] = samples
-                    caller.add_call(call)
+                caller_calls = caller.calls
+                call = caller_calls.get(callee.id)
+                if call is None:
+                    call = Call.make(callee.id, SAMPLES2, samples)
+                    caller_calls[callee.id] = call
                 else:
                     call[SAMPLES2] += samples
 
@@ -2727,8 +3227,7 @@ class PstatsParser:
 
     def get_function_name(self, key):
         filename, line, name = key
-        module = os.path.splitext(filename)[0]
-        module = os.path.basename(module)
+        module = _module_from_filename(filename)
         return "%s:%d:%s" % (module, line, name)
 
     def get_function(self, key):
@@ -2746,37 +3245,40 @@ class PstatsParser:
         return function
 
     def parse(self):
-        self.profile[TIME] = 0.0
-        self.profile[TOTAL_TIME] = self.stats.total_tt
+        # accumulate the profile totals in locals and store them once
+        total_time = 0.0
+        total_time_max = self.stats.total_tt
         for fn, (cc, nc, tt, ct, callers) in self.stats.stats.items():
             callee = self.get_function(fn)
             callee.called = nc
             callee[TOTAL_TIME] = ct
             callee[TIME] = tt
-            self.profile[TIME] += tt
-            self.profile[TOTAL_TIME] = max(self.profile[TOTAL_TIME], ct)
+            total_time += tt
+            if ct > total_time_max:
+                total_time_max = ct
             for fn, value in callers.items():
                 caller = self.get_function(fn)
                 call = Call(callee.id)
                 if isinstance(value, tuple):
+                    # sum in locals and store once instead of testing and
+                    # re-subscripting the call per slice
+                    cc_sum = 0
+                    ct_sum = 0.0
                     for i in range(0, len(value), 4):
                         nc, cc, tt, ct = value[i:i+4]
-                        if CALLS in call:
-                            call[CALLS] += cc
-                        else:
-                            call[CALLS] = cc
-
-                        if TOTAL_TIME in call:
-                            call[TOTAL_TIME] += ct
-                        else:
-                            call[TOTAL_TIME] = ct
-
+                        cc_sum += cc
+                        ct_sum += ct
+                    call[CALLS] = cc_sum
+                    call[TOTAL_TIME] = ct_sum
                 else:
                     call[CALLS] = value
                     call[TOTAL_TIME] = ratio(value, nc)*ct
 
                 caller.add_call(call)
 
+        self.profile[TIME] = total_time
+        self.profile[TOTAL_TIME] = total_time_max
+
         if False:
             self.stats.print_stats()
             self.stats.print_callees()
@@ -2788,6 +3290,14 @@ class PstatsParser:
 
         return self.profile
 
+# hoisted to module scope so per-frame parsing reaches the compiled
+# methods with a single global load instead of two attribute derefs
+_dtrace_call_re = re.compile(r'^\s+(?P<module>.*)`(?P<symbol>.*)')
+_dtrace_addr2_re = re.compile(r'\+0x[0-9a-fA-F]+$')
+_dtrace_call_match = _dtrace_call_re.match
+_dtrace_addr2_sub = _dtrace_addr2_re.sub
+
+
 class DtraceParser(LineParser):
     """Parser for linux perf callgraph output.
 
@@ -2809,6 +3319,10 @@ class DtraceParser(LineParser):
     def __init__(self, infile):
         LineParser.__init__(self, infile)
         self.profile = Profile()
+        # (symbol, module) -> Function; identical frames recur millions
+        # of times, so skip rebuilding and rehashing the id string
+        self._frame_cache = {}
+        self._event_counter = 0
 
     def readline(self):
         # Override LineParser.readline to ignore comment lines
@@ -2842,29 +3356,66 @@ class DtraceParser(LineParser):
         profile.find_cycles()
         profile.ratio(TIME_RATIO, SAMPLES)
         profile.call_ratios(SAMPLES2)
-        if totalMethod == "callratios":
-            # Heuristic approach.  TOTAL_SAMPLES is unused.
-            profile.integrate(TOTAL_TIME_RATIO, TIME_RATIO)
-        elif totalMethod == "callstacks":
-            # Use the actual call chains for functions.
-            profile[TOTAL_SAMPLES] = profile[SAMPLES]
-            profile.ratio(TOTAL_TIME_RATIO, TOTAL_SAMPLES)
-            # Then propagate that total time to the calls.
-            for function in profile.functions.values():
-                for call in function.calls.values():
-                    if call.ratio is not None:
-                        callee = profile.functions[call.callee_id]
-                        call[TOTAL_TIME_RATIO] = call.ratio * callee[TOTAL_TIME_RATIO]
-        else:
-            assert False
+        integrate_total(profile)
 
         return profile
 
+    call_re = _dtrace_call_re
+    addr2_re = _dtrace_addr2_re
+
     def parse_event(self):
+        # One flat loop handles a whole sample: the old
+        # parse_callchain/parse_call split cost two extra interpreter
+        # frames per stack frame.  Going straight to the stream
+        # iterator is not possible because readline() filters out the
+        # CPU header lines.
         if self.eof():
             return
 
-        callchain, count = self.parse_callchain()
+        callchain = []
+        append = callchain.append
+        lookahead = self.lookahead
+        consume = self.consume
+        match = _dtrace_call_match
+        functions = self.profile.functions
+        frame_cache = self._frame_cache
+        count = 0
+        while lookahead():
+            line = consume()
+            mo = match(line)
+            if not mo:
+                # The line must be the stack count
+                count = int(line.strip())
+                break
+
+            function_name = mo.group('symbol')
+
+            # If present, amputate program counter from function name.
+            # The literal test skips the regex for the vast majority of
+            # symbols that carry no suffix.
+            if function_name and '+0x' in function_name:
+                function_name = _dtrace_addr2_sub('', function_name)
+
+            # if not function_name or function_name == '[unknown]':
+            #     function_name = mo.group('address')
+
+            module = mo.group('module')
+
+            key = (function_name, module)
+            function = frame_cache.get(key)
+            if function is None:
+                function_id = sys.intern(function_name + ':' + module)
+                function = functions.get(function_id)
+                if function is None:
+                    function = Function(function_id, function_name)
+                    function.module = _basename(module)
+                    function[SAMPLES] = 0
+                    function[TOTAL_SAMPLES] = 0
+                    self.profile.add_function(function)
+                frame_cache[key] = function
+
+            append(function)
+
         if not callchain:
             return
 
@@ -2873,66 +3424,28 @@ class DtraceParser(LineParser):
         self.profile[SAMPLES] += count
 
         for caller in callchain[1:]:
-            try:
-                call = caller.calls[callee.id]
-            except KeyError:
-                call = Call(callee.id)
-                call[SAMPLES2] = count
-                caller.add_call(call)
+            caller_calls = caller.calls
+            call = caller_calls.get(callee.id)
+            if call is None:
+                call = Call.make(callee.id, SAMPLES2, count)
+                caller_calls[callee.id] = call
             else:
                 call[SAMPLES2] += count
 
             callee = caller
 
-        # Increment TOTAL_SAMPLES only once on each function.
-        stack = set(callchain)
-        for function in stack:
-            function[TOTAL_SAMPLES] += count
-
+        # Increment TOTAL_SAMPLES only once on each function, using the
+        # same event-marker dedup as the perf and collapse parsers
+        self._event_counter += 1
+        eid = self._event_counter
+        for function in callchain:
+            if function._last_eid != eid:
+                function._last_eid = eid
+                function[TOTAL_SAMPLES] += count
 
-    def parse_callchain(self):
-        callchain = []
-        count = 0
-        while self.lookahead():
-            function, count = self.parse_call()
-            if function is None:
-                break
-            callchain.append(function)
-        return callchain, count
-
-    call_re = re.compile(r'^\s+(?P<module>.*)`(?P<symbol>.*)')
-    addr2_re = re.compile(r'\+0x[0-9a-fA-F]+$')
-
-    def parse_call(self):
-        line = self.consume()
-        mo = self.call_re.match(line)
-        if not mo:
-            # The line must be the stack count
-            return None, int(line.strip())
-
-        function_name = mo.group('symbol')
-
-        # If present, amputate program counter from function name.
-        if function_name:
-            function_name = re.sub(self.addr2_re, '', function_name)
-
-        # if not function_name or function_name == '[unknown]':
-        #     function_name = mo.group('address')
-
-        module = mo.group('module')
-
-        function_id = function_name + ':' + module
-
-        try:
-            function = self.profile.functions[function_id]
-        except KeyError:
-            function = Function(function_id, function_name)
-            function.module = os.path.basename(module)
-            function[SAMPLES] = 0
-            function[TOTAL_SAMPLES] = 0
-            self.profile.add_function(function)
 
-        return function, None
+_collapse_call_re = re.compile(r'^(?P<func>[^ ]+) \((?P<file>.*):(?P<line>[0-9]+)\)$')
+_collapse_call_match = _collapse_call_re.match
 
 
 class CollapseParser(LineParser):
@@ -2944,6 +3457,10 @@ class CollapseParser(LineParser):
     def __init__(self, infile):
         LineParser.__init__(self, infile)
         self.profile = Profile()
+        # raw call-site string -> Function; stacks share prefixes, so
+        # the same frame strings recur constantly
+        self._func_cache = {}
+        self._event_counter = 0
 
     def parse(self):
         profile = self.profile
@@ -2958,29 +3475,15 @@ class CollapseParser(LineParser):
         profile.find_cycles()
         profile.ratio(TIME_RATIO, SAMPLES)
         profile.call_ratios(SAMPLES2)
-        if totalMethod == "callratios":
-            # Heuristic approach.  TOTAL_SAMPLES is unused.
-            profile.integrate(TOTAL_TIME_RATIO, TIME_RATIO)
-        elif totalMethod == "callstacks":
-            # Use the actual call chains for functions.
-            profile[TOTAL_SAMPLES] = profile[SAMPLES]
-            profile.ratio(TOTAL_TIME_RATIO, TOTAL_SAMPLES)
-            # Then propagate that total time to the calls.
-            for function in compat_itervalues(profile.functions):
-                for call in compat_itervalues(function.calls):
-                    if call.ratio is not None:
-                        callee = profile.functions[call.callee_id]
-                        call[TOTAL_TIME_RATIO] = call.ratio * callee[TOTAL_TIME_RATIO]
-        else:
-            assert False
+        integrate_total(profile)
 
         return profile
 
     def parse_event(self):
         line = self.consume()
 
-        stack, count = line.rsplit(' ',maxsplit=1)
-        count=int(count)
+        stack, _, count = line.rpartition(' ')
+        count = int(count)
         self.profile[SAMPLES] += count
 
         calls = stack.split(';')
@@ -2988,9 +3491,14 @@ class CollapseParser(LineParser):
 
         functions[-1][SAMPLES] += count
 
-        # TOTAL_SAMPLES excludes loops
-        for func in set(functions):
-            func[TOTAL_SAMPLES] += count
+        # TOTAL_SAMPLES excludes loops; marking each function with the
+        # current event number dedupes without building a set per line
+        self._event_counter += 1
+        eid = self._event_counter
+        for func in functions:
+            if func._last_eid != eid:
+                func._last_eid = eid
+                func[TOTAL_SAMPLES] += count
 
         # add call data
         callee = functions[-1]
@@ -3003,7 +3511,7 @@ class CollapseParser(LineParser):
             call[SAMPLES2] += count
             callee = caller
 
-    call_re = re.compile(r'^(?P<func>[^ ]+) \((?P<file>.*):(?P<line>[0-9]+)\)$')
+    call_re = _collapse_call_re
 
     def _make_function(self, call):
         """turn a call str into a Function
@@ -3011,7 +3519,13 @@ class CollapseParser(LineParser):
         takes a call site, as found between semicolons in the input, and returns
         a Function definition corresponding to that call site.
         """
-        mo = self.call_re.match(call)
+        func = self._func_cache.get(call)
+        if func is not None:
+            return func
+
+        # the '(file:line)' form always contains ' ('; testing for the
+        # literal first spares plain symbols the regex
+        mo = _collapse_call_match(call) if ' (' in call else None
         if mo:
             name, module, line = mo.groups()
             func_id = "%s:%s" % (module, name)
@@ -3026,6 +3540,7 @@ class CollapseParser(LineParser):
             func[SAMPLES] = 0
             func[TOTAL_SAMPLES] = 0
             self.profile.add_function(func)
+        self._func_cache[call] = func
         return func
 
 
@@ -3076,8 +3591,20 @@ class Theme:
         self.minpenwidth = minpenwidth
         self.maxpenwidth = maxpenwidth
         self.gamma = gamma
+        self._color_cache = {}
         self.skew = skew
 
+    @property
+    def skew(self):
+        return self._skew
+
+    @skew.setter
+    def skew(self, skew):
+        # cached colors bake in the skew, so changing it (as main() does
+        # on the shared theme instances for --skew) must drop them
+        self._skew = skew
+        self._color_cache.clear()
+
     def graph_bgcolor(self):
         return self.hsl_to_rgb(*self.bgcolor)
 
@@ -3118,6 +3645,16 @@ class Theme:
         return max(weight**2 * self.maxfontsize, self.minfontsize)
 
     def color(self, weight):
+        # nodes and edges request the same weights repeatedly; memoize
+        # the branchy interpolation and gamma correction
+        try:
+            return self._color_cache[weight]
+        except KeyError:
+            pass
+        rgb = self._color_cache[weight] = self._color(weight)
+        return rgb
+
+    def _color(self, weight):
         weight = min(max(weight, 0.0), 1.0)
 
         hmin, smin, lmin = self.mincolor
@@ -3153,18 +3690,21 @@ class Theme:
         else:
             m2 = l + s - l*s
         m1 = l*2.0 - m2
-        r = self._hue_to_rgb(m1, m2, h + 1.0/3.0)
-        g = self._hue_to_rgb(m1, m2, h)
-        b = self._hue_to_rgb(m1, m2, h - 1.0/3.0)
+        hue_to_rgb = self._hue_to_rgb
+        r = hue_to_rgb(m1, m2, h + 1.0/3.0)
+        g = hue_to_rgb(m1, m2, h)
+        b = hue_to_rgb(m1, m2, h - 1.0/3.0)
 
         # Apply gamma correction
-        r **= self.gamma
-        g **= self.gamma
-        b **= self.gamma
+        gamma = self.gamma
+        r **= gamma
+        g **= gamma
+        b **= gamma
 
         return (r, g, b)
 
-    def _hue_to_rgb(self, m1, m2, h):
+    @staticmethod
+    def _hue_to_rgb(m1, m2, h):
         if h < 0.0:
             h += 1.0
         elif h > 1.0:
@@ -3234,6 +3774,14 @@ themes = {
 }
 
 
+def _float2int(f):
+    if f <= 0.0:
+        return 0
+    if f >= 1.0:
+        return 255
+    return int(255.0*f + 0.5)
+
+
 def sorted_iteritems(d):
     # Used mostly for result reproducibility (while testing.)
     keys = list(d.keys())
@@ -3256,16 +3804,31 @@ class DotWriter:
 
     def __init__(self, fp):
         self.fp = fp
-
-    def wrap_function_name(self, name):
+        # emission produces many tiny fragments; collect them and hand
+        # the file object a single string per graph
+        self._buf = []
+        # oversized ids are hashed once, not once per referencing edge
+        self._id_hash_cache = {}
+
+    # textwrap.fill builds a fresh TextWrapper per call; share one per
+    # width instead
+    _wrappers = {}
+
+    @staticmethod
+    @functools.lru_cache(maxsize=4096)
+    def wrap_function_name(name):
         """Split the function name on multiple lines."""
 
         if len(name) > 32:
             ratio = 2.0/3.0
             height = max(int(len(name)/(1.0 - ratio) + 0.5), 1)
             width = max(len(name)/height, 32)
+            wrapper = DotWriter._wrappers.get(width)
+            if wrapper is None:
+                wrapper = DotWriter._wrappers[width] = \
+                    textwrap.TextWrapper(width=width, break_long_words=False)
             # TODO: break lines in symbols
-            name = textwrap.fill(name, width, break_long_words=False)
+            name = wrapper.fill(name)
 
         # Take away spaces
         name = name.replace(", ", ",")
@@ -3274,8 +3837,8 @@ class DotWriter:
 
         return name
 
-    show_function_events = [TOTAL_TIME_RATIO, TIME_RATIO]
-    show_edge_events = [TOTAL_TIME_RATIO, CALLS]
+    show_function_events = (TOTAL_TIME_RATIO, TIME_RATIO)
+    show_edge_events = (TOTAL_TIME_RATIO, CALLS)
 
     def graphs_compare(self, profile1, profile2, theme, options):
         self.begin_graph()
@@ -3287,12 +3850,22 @@ class DotWriter:
 
         tolerance, only_slower, only_faster, color_by_difference = (
             options.tolerance, options.only_slower, options.only_faster, options.color_by_difference)
+        decimals = tolerance_decimals(tolerance)
         self.attr('graph', fontname=fontname, ranksep=0.25, nodesep=0.125, bgcolor=bgcolor)
         self.attr('node', fontname=fontname, style=nodestyle, fontcolor=fontcolor, width=0, height=0)
         self.attr('edge', fontname=fontname)
 
         functions2 = {function.name: function for _, function in sorted_iteritems(profile2.functions)}
 
+        # scans both profiles, so compute it once rather than per function
+        if color_by_difference:
+            min_diff, max_diff = min_max_difference(profile1, profile2)
+
+        # identical weights recur across elements; compute and format
+        # each distinct weight's attributes only once
+        node_attr_cache = {}
+        edge_attr_cache = {}
+
         for _, function1 in sorted_iteritems(profile1.functions):
             labels = []
 
@@ -3301,14 +3874,12 @@ class DotWriter:
                 function2 = functions2[name]
                 if self.wrap:
                     name = self.wrap_function_name(name)
-                if color_by_difference:
-                    min_diff, max_diff = min_max_difference(profile1, profile2)
                 labels.append(name)
                 weight_difference = 0
                 shape = 'box'
                 orientation = '0'
                 for event in self.show_function_events:
-                    if event in function1.events:
+                    if event in function1:
                         event1 = function1[event]
                         event2 = function2[event]
 
@@ -3320,12 +3891,12 @@ class DotWriter:
                                 if event2 > event1 and not only_faster:
                                     shape = 'cds'
                                     label = (f'{event.format(event1)} +'
-                                             f' {round_difference(difference, tolerance)}%')
+                                             f' {round_difference(difference, decimals)}%')
                                 elif event2 < event1 and not only_slower:
                                     orientation = "90"
                                     shape = 'cds'
                                     label = (f'{event.format(event1)} - '
-                                             f'{round_difference(difference, tolerance)}%')
+                                             f'{round_difference(difference, decimals)}%')
                                 else:
                                     # protection to not color by difference if we choose to show only_faster/only_slower
                                     weight_difference = 0
@@ -3337,10 +3908,10 @@ class DotWriter:
                             if difference >= tolerance:
                                 if event2 > event1:
                                     label = (f'{event.format(event1)} +'
-                                             f' {round_difference(difference, tolerance)}%')
+                                             f' {round_difference(difference, decimals)}%')
                                 elif event2 < event1:
                                     label = (f'{event.format(event1)} - '
-                                             f'{round_difference(difference, tolerance)}%')
+                                             f'{round_difference(difference, decimals)}%')
                             else:
                                 label = event.format(function1[event])
 
@@ -3361,8 +3932,6 @@ class DotWriter:
                     function_name = function1.stripped_name()
                 else:
                     function_name = function1.name
-                if color_by_difference:
-                    min_diff, max_diff = 0, 0
 
                 # dot can't parse quoted strings longer than YY_BUF_SIZE, which
                 # defaults to 16K. But some annotated C++ functions (e.g., boost,
@@ -3377,7 +3946,7 @@ class DotWriter:
                 labels.append(function_name)
 
                 for event in self.show_function_events:
-                    if event in function1.events:
+                    if event in function1:
                         label = event.format(function1[event])
                         labels.append(label)
                 if function1.called is not None:
@@ -3394,18 +3963,29 @@ class DotWriter:
 
             label = '\n'.join(labels)
 
+            node_attrs = node_attr_cache.get(weight)
+            if node_attrs is None:
+                node_attrs = node_attr_cache[weight] = (
+                    self.color(theme.node_bgcolor(weight)),
+                    self.color(theme.node_fgcolor(weight)),
+                    "%f" % theme.node_fontsize(weight),
+                )
+            node_color, node_fontcolor, node_fontsize = node_attrs
             self.node(function1.id,
                       label=label,
                       orientation=orientation,
-                      color=self.color(theme.node_bgcolor(weight)),
+                      color=node_color,
                       shape=shape,
-                      fontcolor=self.color(theme.node_fgcolor(weight)),
-                      fontsize="%f" % theme.node_fontsize(weight),
+                      fontcolor=node_fontcolor,
+                      fontsize=node_fontsize,
                       tooltip=function1.filename,
                       )
 
-            calls2 = {call.callee_id: call for _, call in sorted_iteritems(function2.calls)}
-            functions_by_id1 = {function.id: function for _, function in sorted_iteritems(profile1.functions)}
+            # function2.calls is already keyed by callee id, and
+            # profile1.functions by function id; rebuilding (and sorting)
+            # those mappings per function made the pass quadratic
+            calls2 = function2.calls
+            functions_by_id1 = profile1.functions
 
             for _, call1 in sorted_iteritems(function1.calls):
                 labels = []
@@ -3416,25 +3996,34 @@ class DotWriter:
                     call_id2 = functions2[call_name].id
                     call2 = calls2[call_id2]
                     for event in self.show_edge_events:
-                        if event in call1.events:
+                        if event in call1:
                             label = f'{event.format(call1[event])} / {event.format(call2[event])}'
                             labels.append(label)
                 except KeyError:
                     for event in self.show_edge_events:
-                        if event in call1.events:
+                        if event in call1:
                             label = f'{event.format(call1[event])}'
                             labels.append(label)
 
                 weight = 0 if color_by_difference else call1.weight
                 label = '\n'.join(labels)
+                edge_attrs = edge_attr_cache.get(weight)
+                if edge_attrs is None:
+                    edge_attrs = edge_attr_cache[weight] = (
+                        self.color(theme.edge_color(weight)),
+                        "%.2f" % theme.edge_fontsize(weight),
+                        "%.2f" % theme.edge_penwidth(weight),
+                        "%.2f" % theme.edge_arrowsize(weight),
+                    )
+                edge_color, edge_fontsize, edge_penwidth, edge_arrowsize = edge_attrs
                 self.edge(function1.id, call1.callee_id,
                           label=label,
-                          color=self.color(theme.edge_color(weight)),
-                          fontcolor=self.color(theme.edge_color(weight)),
-                          fontsize="%.2f" % theme.edge_fontsize(weight),
-                          penwidth="%.2f" % theme.edge_penwidth(weight),
-                          labeldistance="%.2f" % theme.edge_penwidth(weight),
-                          arrowsize="%.2f" % theme.edge_arrowsize(weight),
+                          color=edge_color,
+                          fontcolor=edge_color,
+                          fontsize=edge_fontsize,
+                          penwidth=edge_penwidth,
+                          labeldistance=edge_penwidth,
+                          arrowsize=edge_arrowsize,
                           )
         self.end_graph()
 
@@ -3450,6 +4039,11 @@ class DotWriter:
         self.attr('node', fontname=fontname, shape="box", style=nodestyle, fontcolor=fontcolor, width=0, height=0)
         self.attr('edge', fontname=fontname)
 
+        # identical weights recur across elements; compute and format
+        # each distinct weight's attributes only once
+        node_attr_cache = {}
+        edge_attr_cache = {}
+
         for _, function in sorted_iteritems(profile.functions):
             labels = []
             if function.process is not None:
@@ -3475,7 +4069,7 @@ class DotWriter:
             labels.append(function_name)
 
             for event in self.show_function_events:
-                if event in function.events:
+                if event in function:
                     label = event.format(function[event])
                     labels.append(label)
             if function.called is not None:
@@ -3487,11 +4081,19 @@ class DotWriter:
                 weight = 0.0
 
             label = '\n'.join(labels)
+            node_attrs = node_attr_cache.get(weight)
+            if node_attrs is None:
+                node_attrs = node_attr_cache[weight] = (
+                    self.color(theme.node_bgcolor(weight)),
+                    self.color(theme.node_fgcolor(weight)),
+                    "%.2f" % theme.node_fontsize(weight),
+                )
+            color, node_fontcolor, fontsize = node_attrs
             self.node(function.id,
                 label = label,
-                color = self.color(theme.node_bgcolor(weight)),
-                fontcolor = self.color(theme.node_fgcolor(weight)),
-                fontsize = "%.2f" % theme.node_fontsize(weight),
+                color = color,
+                fontcolor = node_fontcolor,
+                fontsize = fontsize,
                 tooltip = function.filename,
             )
 
@@ -3500,7 +4102,7 @@ class DotWriter:
 
                 labels = []
                 for event in self.show_edge_events:
-                    if event in call.events:
+                    if event in call:
                         label = event.format(call[event])
                         labels.append(label)
 
@@ -3513,14 +4115,23 @@ class DotWriter:
 
                 label = '\n'.join(labels)
 
+                edge_attrs = edge_attr_cache.get(weight)
+                if edge_attrs is None:
+                    edge_attrs = edge_attr_cache[weight] = (
+                        self.color(theme.edge_color(weight)),
+                        "%.2f" % theme.edge_fontsize(weight),
+                        "%.2f" % theme.edge_penwidth(weight),
+                        "%.2f" % theme.edge_arrowsize(weight),
+                    )
+                color, fontsize, penwidth, arrowsize = edge_attrs
                 self.edge(function.id, call.callee_id,
                     label = label,
-                    color = self.color(theme.edge_color(weight)),
-                    fontcolor = self.color(theme.edge_color(weight)),
-                    fontsize = "%.2f" % theme.edge_fontsize(weight),
-                    penwidth = "%.2f" % theme.edge_penwidth(weight),
-                    labeldistance = "%.2f" % theme.edge_penwidth(weight),
-                    arrowsize = "%.2f" % theme.edge_arrowsize(weight),
+                    color = color,
+                    fontcolor = color,
+                    fontsize = fontsize,
+                    penwidth = penwidth,
+                    labeldistance = penwidth,
+                    arrowsize = arrowsize,
                 )
 
         self.end_graph()
@@ -3535,45 +4146,29 @@ class DotWriter:
 
     def end_graph(self):
         self.write('}\n')
+        self.flush()
+
+    # each element is rendered into a single string so emission costs
+    # one buffered write per statement instead of one per token
 
     def attr(self, what, **attrs):
-        self.write("\t")
-        self.write(what)
-        self.attr_list(attrs)
-        self.write(";\n")
+        self.write('\t' + what + self.attr_list(attrs) + ';\n')
 
     def node(self, node, **attrs):
-        self.write("\t")
-        self.node_id(node)
-        self.attr_list(attrs)
-        self.write(";\n")
+        self.write('\t' + self.node_id(node) + self.attr_list(attrs) + ';\n')
 
     def edge(self, src, dst, **attrs):
-        self.write("\t")
-        self.node_id(src)
-        self.write(" -> ")
-        self.node_id(dst)
-        self.attr_list(attrs)
-        self.write(";\n")
+        self.write('\t' + self.node_id(src) + ' -> ' + self.node_id(dst)
+                   + self.attr_list(attrs) + ';\n')
 
     def attr_list(self, attrs):
         if not attrs:
-            return
-        self.write(' [')
-        first = True
-        for name, value in sorted_iteritems(attrs):
-            if value is None:
-                continue
-            if first:
-                first = False
-            else:
-                self.write(", ")
-            assert isinstance(name, str)
-            assert name.isidentifier()
-            self.write(name)
-            self.write('=')
-            self.id(value)
-        self.write(']')
+            return ''
+        id = self.id
+        return ' [' + ', '.join(
+            name + '=' + id(value)
+            for name, value in sorted_iteritems(attrs)
+            if value is not None) + ']'
 
     def node_id(self, id):
         # Node IDs need to be unique (can't be truncated) but dot doesn't allow
@@ -3581,42 +4176,51 @@ class DotWriter:
         # C++ symbols that can arise, as seen in
         # https://github.com/jrfonseca/gprof2dot/issues/99
         if isinstance(id, str) and len(id) > 1024:
-            id = '_' + hashlib.sha1(id.encode('utf-8'), usedforsecurity=False).hexdigest()
-        self.id(id)
+            cached = self._id_hash_cache.get(id)
+            if cached is None:
+                cached = '_' + hashlib.sha1(id.encode('utf-8'), usedforsecurity=False).hexdigest()
+                self._id_hash_cache[id] = cached
+            id = cached
+        return self.id(id)
 
     def id(self, id):
         if isinstance(id, (int, float)):
-            s = str(id)
+            return str(id)
         elif isinstance(id, str):
             if id.isalnum() and not id.startswith('0x'):
-                s = id
-            else:
-                s = self.escape(id)
+                return id
+            return self.escape(id)
         else:
             raise TypeError
-        self.write(s)
 
     def color(self, rgb):
         r, g, b = rgb
+        float2int = _float2int
+        return '#%02x%02x%02x' % (float2int(r), float2int(g), float2int(b))
 
-        def float2int(f):
-            if f <= 0.0:
-                return 0
-            if f >= 1.0:
-                return 255
-            return int(255.0*f + 0.5)
-
-        return "#" + "".join(["%02x" % float2int(c) for c in (r, g, b)])
+    # one C-level pass instead of four sequential str.replace scans
+    _escape_table = str.maketrans({
+        '\\': r'\\',
+        '\n': r'\n',
+        '\t': r'\t',
+        '"': r'\"',
+    })
 
     def escape(self, s):
-        s = s.replace('\\', r'\\')
-        s = s.replace('\n', r'\n')
-        s = s.replace('\t', r'\t')
-        s = s.replace('"', r'\"')
-        return '"' + s + '"'
+        return '"' + s.translate(self._escape_table) + '"'
 
     def write(self, s):
-        self.fp.write(s)
+        self._buf.append(s)
+
+    def flush(self):
+        data = ''.join(self._buf)
+        self._buf.clear()
+        if isinstance(self.fp, io.TextIOBase):
+            self.fp.write(data)
+        else:
+            # binary sink: one whole-graph encode, skipping the text
+            # layer's incremental encoder
+            self.fp.write(data.encode('utf-8'))
 
 
 
@@ -3632,160 +4236,162 @@ def naturalJoin(values):
         return ''.join(values)
 
 
-def main(argv=sys.argv[1:]):
-    """Main program."""
+# the option choices and their joined help-string forms never change, so
+# build them once at import instead of on every main() invocation
+formatNames = sorted(formats)
+themeNames = sorted(themes)
+labelNames = sorted(labels)
 
-    global totalMethod, timeFormat
+formatNamesJoined = naturalJoin(formatNames)
+themeNamesJoined = naturalJoin(themeNames)
+labelNamesJoined = naturalJoin(labelNames)
 
-    formatNames = list(formats.keys())
-    formatNames.sort()
 
-    themeNames = list(themes.keys())
-    themeNames.sort()
+def main(argv=sys.argv[1:]):
+    """Main program."""
 
-    labelNames = list(labels.keys())
-    labelNames.sort()
+    global totalMethod, timeFormat
 
-    optparser = optparse.OptionParser(
-        usage="\n\t%prog [options] [file] ...")
-    optparser.add_option(
+    argparser = argparse.ArgumentParser(
+        usage="\n\t%(prog)s [options] [file] ...")
+    argparser.add_argument(
+        'args', metavar='file', nargs='*',
+        help=argparse.SUPPRESS)
+    argparser.add_argument(
         '-o', '--output', metavar='FILE',
-        type="string", dest="output",
+        dest="output",
         help="output filename [stdout]")
-    optparser.add_option(
+    argparser.add_argument(
         '-n', '--node-thres', metavar='PERCENTAGE',
-        type="float", dest="node_thres", default=0.5,
-        help="eliminate nodes below this threshold [default: %default]")
-    optparser.add_option(
+        type=float, dest="node_thres", default=0.5,
+        help="eliminate nodes below this threshold [default: %(default)s]")
+    argparser.add_argument(
         '-e', '--edge-thres', metavar='PERCENTAGE',
-        type="float", dest="edge_thres", default=0.1,
-        help="eliminate edges below this threshold [default: %default]")
-    optparser.add_option(
+        type=float, dest="edge_thres", default=0.1,
+        help="eliminate edges below this threshold [default: %(default)s]")
+    argparser.add_argument(
         '-f', '--format',
-        type="choice", choices=formatNames,
+        choices=formatNames,
         dest="format", default="prof",
-        help="profile format: %s [default: %%default]" % naturalJoin(formatNames))
-    optparser.add_option(
+        help="profile format: %s [default: %%(default)s]" % formatNamesJoined)
+    argparser.add_argument(
         '--total',
-        type="choice", choices=('callratios', 'callstacks'),
+        choices=('callratios', 'callstacks'),
         dest="totalMethod", default=totalMethod,
-        help="preferred method of calculating total time: callratios or callstacks (currently affects only perf format) [default: %default]")
-    optparser.add_option(
+        help="preferred method of calculating total time: callratios or callstacks (currently affects only perf format) [default: %(default)s]")
+    argparser.add_argument(
         '-c', '--colormap',
-        type="choice", choices=themeNames,
+        choices=themeNames,
         dest="theme", default="color",
-        help="color map: %s [default: %%default]" % naturalJoin(themeNames))
-    optparser.add_option(
+        help="color map: %s [default: %%(default)s]" % themeNamesJoined)
+    argparser.add_argument(
         '-s', '--strip',
         action="store_true",
         dest="strip", default=False,
         help="strip function parameters, template parameters, and const modifiers from demangled C++ function names")
-    optparser.add_option(
+    argparser.add_argument(
         '--color-nodes-by-selftime',
         action="store_true",
         dest="color_nodes_by_selftime", default=False,
         help="color nodes by self time, rather than by total time (sum of self and descendants)")
-    optparser.add_option(
+    argparser.add_argument(
         '--colour-nodes-by-selftime',
         action="store_true",
         dest="color_nodes_by_selftime",
-        help=optparse.SUPPRESS_HELP)
-    optparser.add_option(
+        help=argparse.SUPPRESS)
+    argparser.add_argument(
         '-w', '--wrap',
         action="store_true",
         dest="wrap", default=False,
         help="wrap function names")
-    optparser.add_option(
+    argparser.add_argument(
         '--show-samples',
         action="store_true",
         dest="show_samples", default=False,
         help="show function samples")
-    optparser.add_option(
+    argparser.add_argument(
         '--time-format',
         default=timeFormat,
-        help="format to use for showing time values [default: %default]")
-    optparser.add_option(
+        help="format to use for showing time values [default: %(default)s]")
+    argparser.add_argument(
         '--node-label', metavar='MEASURE',
-        type='choice', choices=labelNames,
+        choices=labelNames,
         action='append',
         dest='node_labels',
         help="measurements to on show the node (can be specified multiple times): %s [default: %s]" % (
-            naturalJoin(labelNames), ', '.join(defaultLabelNames)))
+            labelNamesJoined, ', '.join(defaultLabelNames)))
     # add option to show information on available entries ()
-    optparser.add_option(
+    argparser.add_argument(
         '--list-functions',
-        type="string",
         dest="list_functions", default=None,
         help="""\
 list functions available for selection in -z or -l, requires selector argument
 ( use '+' to select all).
 Recall that the selector argument is used with Unix/Bash globbing/pattern matching,
 and that entries are formatted '<pkg>:<linenum>:<function>'. When argument starts
-with '%', a dump of all available information is performed for selected entries,
- after removal of leading '%'.
+with '%%', a dump of all available information is performed for selected entries,
+ after removal of leading '%%'.
 """)
     # add option to create subtree or show paths
-    optparser.add_option(
+    argparser.add_argument(
         '-z', '--root',
-        type="string",
         dest="root", default="",
         help="prune call graph to show only descendants of specified root function")
-    optparser.add_option(
+    argparser.add_argument(
         '-l', '--leaf',
-        type="string",
         dest="leaf", default="",
         help="prune call graph to show only ancestors of specified leaf function")
-    optparser.add_option(
+    argparser.add_argument(
         '--depth',
-        type="int",
+        type=int,
         dest="depth", default=-1,
         help="prune call graph to show only descendants or ancestors until specified depth")
     # add a new option to control skew of the colorization curve
-    optparser.add_option(
+    argparser.add_argument(
         '--skew',
-        type="float", dest="theme_skew", default=1.0,
+        type=float, dest="theme_skew", default=1.0,
         help="skew the colorization curve.  Values < 1.0 give more variety to lower percentages.  Values > 1.0 give less variety to lower percentages")
     # add option for filtering by file path
-    optparser.add_option(
+    argparser.add_argument(
         '-p', '--path', action="append",
-        type="string", dest="filter_paths",
+        dest="filter_paths",
         help="Filter all modules not in a specified path")
-    optparser.add_option(
+    argparser.add_argument(
         '--compare',
         action="store_true",
         dest="compare", default=False,
         help="Compare two graphs with almost identical structure. With this option two files should be provided."
              "gprof2dot.py [options] --compare [file1] [file2] ...")
-    optparser.add_option(
+    argparser.add_argument(
         '--compare-tolerance',
-        type="float", dest="tolerance", default=0.001,
-        help="Tolerance threshold for node difference (default=0.001%)."
+        type=float, dest="tolerance", default=0.001,
+        help="Tolerance threshold for node difference (default=0.001%%)."
              "If the difference is below this value the nodes are considered identical.")
-    optparser.add_option(
+    argparser.add_argument(
         '--compare-only-slower',
         action="store_true",
         dest="only_slower", default=False,
         help="Display comparison only for function which are slower in second graph.")
-    optparser.add_option(
+    argparser.add_argument(
         '--compare-only-faster',
         action="store_true",
         dest="only_faster", default=False,
         help="Display comparison only for function which are faster in second graph.")
-    optparser.add_option(
+    argparser.add_argument(
         '--compare-color-by-difference',
         action="store_true",
         dest="color_by_difference", default=False,
         help="Color nodes based on the value of the difference. "
              "Nodes with the largest differences represent the hot spots.")
-    (options, args) = optparser.parse_args(argv)
+    options = argparser.parse_args(argv)
+    args = options.args
 
     if len(args) > 1 and options.format != 'pstats' and not options.compare:
-        optparser.error('incorrect number of arguments')
+        argparser.error('incorrect number of arguments')
 
-    try:
-        theme = themes[options.theme]
-    except KeyError:
-        optparser.error('invalid colormap \'%s\'' % options.theme)
+    # choices= has already validated the names, so look them up directly
+    theme = themes[options.theme]
+    Format = formats[options.format]
 
     # set skew on the theme now that it has been picked.
     if options.theme_skew:
@@ -3794,34 +4400,43 @@ with '%', a dump of all available information is performed for selected entries,
     totalMethod = options.totalMethod
     timeFormat = options.time_format
 
-    try:
-        Format = formats[options.format]
-    except KeyError:
-        optparser.error('invalid format \'%s\'' % options.format)
-
     if Format.stdinInput:
         if not args:
             fp = sys.stdin
             parser = Format(fp)
         elif options.compare:
-            fp1 = open(args[0], 'rt', encoding='UTF-8')
-            fp2 = open(args[1], 'rt', encoding='UTF-8')
+            # profiles are consumed via many short reads, so use a large
+            # buffer to amortize refills
+            fp1 = open(args[0], 'rt', encoding='UTF-8', buffering=1 << 20)
+            fp2 = open(args[1], 'rt', encoding='UTF-8', buffering=1 << 20)
             parser1 = Format(fp1)
             parser2 = Format(fp2)
         else:
-            fp = open(args[0], 'rb')
-            bom = fp.read(2)
+            fp = open(args[0], 'rb', buffering=1 << 20)
+            try:
+                # map regular files so the parse reads straight from the
+                # page cache; fails for empty files and special files
+                mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, OSError):
+                # peek() sniffs the BOM without advancing, sparing a seek
+                # and keeping FIFOs and other non-seekable files working
+                bom = fp.peek(2)[:2]
+            else:
+                if hasattr(mm, 'madvise'):
+                    mm.madvise(mmap.MADV_SEQUENTIAL)
+                bom = mm[:2]
+                fp.close()
+                fp = io.BytesIO(mm)
             if bom == codecs.BOM_UTF16_LE:
                 # Default on Windows PowerShell (https://github.com/jrfonseca/gprof2dot/issues/88)
                 encoding = 'utf-16le'
             else:
                 encoding = 'utf-8'
-            fp.seek(0)
             fp = io.TextIOWrapper(fp, encoding=encoding)
             parser = Format(fp)
     elif Format.multipleInput:
         if not args:
-            optparser.error('at least a file must be specified for %s input' % options.format)
+            argparser.error('at least a file must be specified for %s input' % options.format)
         if options.compare:
             parser1 = Format(args[-2])
             parser2 = Format(args[-1])
@@ -3829,47 +4444,58 @@ with '%', a dump of all available information is performed for selected entries,
             parser = Format(*args)
     else:
         if len(args) != 1:
-            optparser.error('exactly one file must be specified for %s input' % options.format)
+            argparser.error('exactly one file must be specified for %s input' % options.format)
         parser = Format(args[0])
 
     if options.compare:
-        profile1 = parser1.parse()
-        profile2 = parser2.parse()
+        # the two inputs are independent, so overlap their parsing
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            future2 = executor.submit(parser2.parse)
+            profile1 = parser1.parse()
+            profile2 = future2.result()
+        # let the parsers' intermediate structures be collected before the
+        # pruned graphs are built and written
+        del parser1, parser2
     else:
         profile = parser.parse()
+        del parser
 
+    # open the output in binary: DotWriter encodes each graph in one go
     if options.output is None:
-        output = open(sys.stdout.fileno(), mode='wt', encoding='UTF-8', closefd=False)
+        output = open(sys.stdout.fileno(), mode='wb', closefd=False,
+                      buffering=1 << 20)
     else:
-        output = open(options.output, 'wt', encoding='UTF-8')
+        output = open(options.output, 'wb', buffering=1 << 20)
 
     dot = DotWriter(output)
     dot.strip = options.strip
     dot.wrap = options.wrap
 
-    labelNames = options.node_labels or defaultLabelNames
-    dot.show_function_events = [labels[l] for l in labelNames]
+    nodeLabelNames = options.node_labels or defaultLabelNames
+    show_function_events = tuple(labels[l] for l in nodeLabelNames)
     if options.show_samples:
-        dot.show_function_events.append(SAMPLES)
+        show_function_events += (SAMPLES,)
+    dot.show_function_events = show_function_events
+
+    node_thres = options.node_thres / 100.0
+    edge_thres = options.edge_thres / 100.0
+    filter_paths = options.filter_paths
+    color_nodes_by_selftime = options.color_nodes_by_selftime
 
     if options.compare:
-        profile1.prune(options.node_thres/100.0, options.edge_thres/100.0, options.filter_paths,
-                       options.color_nodes_by_selftime)
-        profile2.prune(options.node_thres/100.0, options.edge_thres/100.0, options.filter_paths,
-                       options.color_nodes_by_selftime)
-
-        if options.root:
-            profile1.prune_root(profile1.getFunctionIds(options.root), options.depth)
-            profile2.prune_root(profile2.getFunctionIds(options.root), options.depth)
+        profile1.prune_combined(node_thres, edge_thres,
+                                filter_paths, color_nodes_by_selftime,
+                                root=options.root or None, depth=options.depth)
+        profile2.prune_combined(node_thres, edge_thres,
+                                filter_paths, color_nodes_by_selftime,
+                                root=options.root or None, depth=options.depth)
     else:
-        profile.prune(options.node_thres/100.0, options.edge_thres/100.0, options.filter_paths,
-                      options.color_nodes_by_selftime)
-        if options.root:
-            rootIds = profile.getFunctionIds(options.root)
-            if not rootIds:
-                sys.stderr.write('root node ' + options.root + ' not found (might already be pruned : try -e0 -n0 flags)\n')
-                sys.exit(1)
-            profile.prune_root(rootIds, options.depth)
+        rootIds = profile.prune_combined(node_thres, edge_thres,
+                                         filter_paths, color_nodes_by_selftime,
+                                         root=options.root or None, depth=options.depth)
+        if options.root and not rootIds:
+            sys.stderr.write('root node ' + options.root + ' not found (might already be pruned : try -e0 -n0 flags)\n')
+            sys.exit(1)
 
     if options.list_functions:
         profile.printFunctionIds(selector=options.list_functions)
@@ -3887,6 +4513,8 @@ with '%', a dump of all available information is performed for selected entries,
     else:
         dot.graph(profile, theme)
 
+    _warnings.flush()
+
 
 if __name__ == '__main__':
     main()